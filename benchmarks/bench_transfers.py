@@ -0,0 +1,381 @@
+"""
+Offline benchmark for spylib transfers against a simulated Telegram backend.
+
+Senders are replaced by in-process stand-ins that model per-connection
+bandwidth, a per-DC bandwidth cap, round-trip time with jitter, FLOOD_WAIT
+and dropped connection injection and the export/import round-trips of
+cross-DC authorization. Everything above the sender (pooling, scheduling,
+tuning, retries, disk I/O) is the real code.
+
+With --verify, or whenever errors are injected, downloaded bytes and
+uploaded parts are checked against what the backend serves and received.
+
+    python benchmarks/bench_transfers.py --sizes 16,128 --connections auto,8,20
+"""
+
+import argparse
+import asyncio
+import gc
+import hashlib
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "devgagantools"))
+
+import spylib  # noqa: E402
+from telethon.crypto import AuthKey  # noqa: E402
+from telethon.errors import FloodWaitError  # noqa: E402
+from telethon.tl.functions import InvokeWithLayerRequest  # noqa: E402
+from telethon.tl.functions.auth import (  # noqa: E402
+    ExportAuthorizationRequest,
+    ImportAuthorizationRequest,
+)
+from telethon.tl.functions.upload import (  # noqa: E402
+    GetFileRequest,
+    SaveBigFilePartRequest,
+    SaveFilePartRequest,
+)
+from telethon.tl.types import Document, User  # noqa: E402
+from telethon.tl.types.auth import ExportedAuthorization  # noqa: E402
+from telethon.tl.types.storage import FileUnknown  # noqa: E402
+from telethon.tl.types.upload import File  # noqa: E402
+
+MB = 1024 * 1024
+HOME_DC = 2
+
+
+class Link:
+    """
+    A pipe with a fixed bandwidth: requests queue up for it, but a request
+    does not wait for the previous one's round-trip, just like pipelined
+    MTProto requests on one connection.
+    """
+
+    def __init__(self, bandwidth: float) -> None:
+        self.bandwidth = bandwidth
+        self.free_at = 0.0
+
+    def reserve(self, nbytes: int, earliest: float) -> float:
+        start = max(earliest, self.free_at)
+        self.free_at = start + nbytes / self.bandwidth
+        return self.free_at
+
+
+class SimulatedBackend:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.dc_links = {}
+        self.exports = 0
+        self.imports = 0
+        self.floods = 0
+        self.errors = 0
+        self.connections = 0
+        # SHA-256 of every uploaded part by index, only kept when checking
+        self.uploaded = {}
+        self.total_parts = set()
+        self._block = os.urandom(MB)
+
+    def dc_link(self, dc_id: int) -> Link:
+        if dc_id not in self.dc_links:
+            self.dc_links[dc_id] = Link(self.args.dc_bandwidth * MB)
+        return self.dc_links[dc_id]
+
+    def delay(self) -> float:
+        return max(0.0, self.args.rtt + random.uniform(-1, 1) * self.args.jitter) / 1000
+
+    def file_bytes(self, offset: int, limit: int, size: int) -> bytes:
+        limit = max(0, min(limit, size - offset))
+        start = offset % MB
+        data = self._block[start:start + limit]
+        while len(data) < limit:
+            data += self._block[:limit - len(data)]
+        # Every 4 KB carries its own offset, so parts that end up in the wrong place don't match
+        data = bytearray(data)
+        for position in range(-offset % 4096, limit, 4096):
+            data[position:position + 8] = (offset + position).to_bytes(8, "little")[:limit - position]
+        return bytes(data)
+
+    async def handle(self, sender: "SimulatedSender", request):
+        if isinstance(request, InvokeWithLayerRequest):
+            request = request.query.query
+        if self.args.flood_rate and random.random() < self.args.flood_rate:
+            self.floods += 1
+            await asyncio.sleep(self.delay())
+            raise FloodWaitError(request, capture=self.args.flood_seconds)
+
+        upload = isinstance(request, (SaveBigFilePartRequest, SaveFilePartRequest))
+        nbytes = len(request.bytes) if upload else getattr(request, "limit", 0)
+        now = time.monotonic()
+        # Both the connection and the DC have to carry the bytes, whichever is slower wins
+        done = max(
+            sender.link.reserve(nbytes, now),
+            self.dc_link(sender.dc_id).reserve(nbytes, now),
+        )
+        await asyncio.sleep(done - now + self.delay())
+
+        if isinstance(request, GetFileRequest):
+            self.drop(sender)
+            return File(
+                FileUnknown(),
+                0,
+                self.file_bytes(request.offset, request.limit, self.args.file_size),
+            )
+        if isinstance(request, ImportAuthorizationRequest):
+            self.imports += 1
+            return None
+        if upload:
+            if self.args.verify:
+                self.uploaded[request.file_part] = hashlib.sha256(request.bytes).digest()
+                self.total_parts.add(getattr(request, "file_total_parts", None))
+            self.drop(sender)
+            return True
+        return [User(id=1)]
+
+    def drop(self, sender: "SimulatedSender") -> None:
+        # The request went through but the connection died before the answer, it is sent again
+        if self.args.error_rate and random.random() < self.args.error_rate:
+            self.errors += 1
+            sender.connected = False
+            raise ConnectionError("Simulated connection loss")
+
+
+class SimulatedSender:
+    def __init__(self, backend: SimulatedBackend, dc_id: int, auth_key) -> None:
+        self.backend = backend
+        self.dc_id = dc_id
+        # A fresh connection to a foreign DC gets its own key, like a new MTProto handshake
+        self.auth_key = auth_key or AuthKey(os.urandom(256))
+        self.link = Link(backend.args.bandwidth * MB)
+        self.connected = True
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    async def disconnect(self) -> None:
+        self.connected = False
+
+    def send(self, request) -> asyncio.Future:
+        return asyncio.ensure_future(self.backend.handle(self, request))
+
+
+class SimulatedClient:
+    def __init__(self, backend: SimulatedBackend) -> None:
+        self.backend = backend
+        self.loop = asyncio.get_running_loop()
+        self.session = type(
+            "Session", (), {"dc_id": HOME_DC, "auth_key": AuthKey(os.urandom(256))}
+        )()
+        self._init_request = type("InitConnection", (), {"query": None})()
+
+    async def __call__(self, request):
+        if isinstance(request, ExportAuthorizationRequest):
+            self.backend.exports += 1
+            await asyncio.sleep(self.backend.delay())
+            return ExportedAuthorization(id=1, bytes=os.urandom(32))
+        raise NotImplementedError(type(request).__name__)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        return await sender.send(request)
+
+
+async def connect_sender(self, auth_key):
+    backend = self.client.backend
+    # TCP plus MTProto handshake
+    await asyncio.sleep(2 * backend.delay())
+    backend.connections += 1
+    return SimulatedSender(backend, self.dc_id, auth_key)
+
+
+spylib.ParallelTransferrer._connect_sender = connect_sender
+
+
+class NullWriter:
+    name = os.devnull
+
+    def __init__(self, verify: bool) -> None:
+        self.size = 0
+        self.hash = hashlib.sha256() if verify else None
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.hash:
+            self.hash.update(data)
+
+
+def check_download(backend: SimulatedBackend, writer: NullWriter, size: int) -> None:
+    if writer.size != size:
+        raise RuntimeError(f"Downloaded {writer.size} bytes of a {size} byte file")
+    expected = hashlib.sha256()
+    for offset in range(0, size, MB):
+        expected.update(backend.file_bytes(offset, MB, size))
+    if writer.hash.digest() != expected.digest():
+        raise RuntimeError("Downloaded bytes don't match the file")
+
+
+def check_upload(backend: SimulatedBackend, path: str, part_size: int) -> None:
+    with open(path, "rb") as f:
+        expected = {
+            index: hashlib.sha256(data).digest()
+            for index, data in enumerate(iter(lambda: f.read(part_size), b""))
+        }
+    if set(backend.uploaded) != set(expected):
+        missing = sorted(set(expected) - set(backend.uploaded))
+        extra = sorted(set(backend.uploaded) - set(expected))
+        raise RuntimeError(f"Uploaded parts are off, missing {missing[:10]}, unexpected {extra[:10]}")
+    bad = [index for index in expected if backend.uploaded[index] != expected[index]]
+    if bad:
+        raise RuntimeError(f"Uploaded parts {bad[:10]} don't match the file")
+    if backend.total_parts - {None, len(expected)}:
+        raise RuntimeError(f"Parts were sent with totals {sorted(backend.total_parts - {None})}")
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run_case(args, direction: str, size: int, connections, workdir: str) -> dict:
+    args.file_size = size
+    backend = SimulatedBackend(args)
+    client = SimulatedClient(backend)
+    # Every case starts cold, without what earlier cases taught the tuner
+    spylib.dc_tuning.clear()
+    latencies = []
+
+    def hook(name, value, labels):
+        if name == "part_seconds":
+            latencies.append(value)
+
+    spylib.add_metrics_hook(hook)
+    if args.memory:
+        tracemalloc.start()
+    gc.collect()
+    cpu, wall = time.process_time(), time.perf_counter()
+    try:
+        if direction == "download":
+            document = Document(
+                id=1, access_hash=1, file_reference=b"", date=None,
+                mime_type="application/octet-stream", size=size, dc_id=args.dc, attributes=[],
+            )
+            transferrer = spylib.ParallelTransferrer(client, args.dc)
+            parts = transferrer.download(document_location(document), size, connection_count=connections)
+            writer = NullWriter(args.verify)
+            try:
+                async for data in parts:
+                    writer.write(data)
+            finally:
+                await parts.aclose()
+        else:
+            path = os.path.join(workdir, f"upload-{size}")
+            with open(path, "rb") as f:
+                transferrer = spylib.ParallelTransferrer(client)
+                part_size = await upload(transferrer, f, size, connections)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        peak = tracemalloc.get_traced_memory()[1] if args.memory else None
+        # Outside of the timing, it would skew cpu_s_gb
+        if args.verify:
+            if direction == "download":
+                check_download(backend, writer, size)
+            else:
+                check_upload(backend, path, part_size)
+    finally:
+        if args.memory:
+            tracemalloc.stop()
+        spylib.remove_metrics_hook(hook)
+        await spylib.close_sender_pools(client)
+
+    return {
+        "direction": direction,
+        "size_mb": size / MB,
+        "connections": connections or "auto",
+        "mb_s": size / MB / wall,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "cpu_s_gb": cpu / (size / 1024 ** 3),
+        "peak_mb": peak / MB if peak is not None else None,
+        "senders": backend.connections,
+        "floods": backend.floods,
+        "errors": backend.errors,
+        "imports": backend.imports,
+    }
+
+
+def document_location(document: Document):
+    _, location = spylib.utils.get_input_location(document)
+    return location
+
+
+async def upload(transferrer, f, size: int, connections) -> int:
+    part_size, _, _ = await transferrer.init_upload(
+        spylib.helpers.generate_random_long(), size, connection_count=connections
+    )
+    reader = spylib.ReadAhead(spylib.PartReader(f, part_size).read)
+    try:
+        async for data in reader:
+            await transferrer.upload(data)
+    except BaseException:
+        await transferrer._cleanup(healthy=False)
+        raise
+    finally:
+        await reader.close()
+    await transferrer.finish_upload()
+    return part_size
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="8,64,256", help="file sizes in MB")
+    parser.add_argument("--connections", default="auto,4,8,20", help="connection counts, auto lets spylib decide")
+    parser.add_argument("--directions", default="download,upload")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the median is reported")
+    parser.add_argument("--bandwidth", type=float, default=4.0, help="MB/s per connection")
+    parser.add_argument("--dc-bandwidth", type=float, default=120.0, help="MB/s per DC")
+    parser.add_argument("--rtt", type=float, default=80.0, help="round-trip time in ms")
+    parser.add_argument("--jitter", type=float, default=20.0, help="+/- ms added to every round-trip")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="chance of FLOOD_WAIT per request")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance of a dropped connection per request")
+    parser.add_argument("--verify", action="store_true", help="check transferred data, on by default with injected errors")
+    parser.add_argument("--dc", type=int, default=HOME_DC, help="DC the downloaded file lives in")
+    parser.add_argument("--memory", action="store_true", help="trace peak memory (slows the run down)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+async def main() -> None:
+    args = parse_args()
+    args.verify = args.verify or bool(args.flood_rate or args.error_rate)
+    random.seed(args.seed)
+    sizes = [int(float(size) * MB) for size in args.sizes.split(",")]
+    connection_counts = [None if c == "auto" else int(c) for c in args.connections.split(",")]
+    columns = ["direction", "size_mb", "connections", "mb_s", "p50_ms", "p99_ms",
+               "cpu_s_gb", "peak_mb", "senders", "floods", "errors", "imports"]
+    print(" ".join(f"{column:>11}" for column in columns))
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            with open(os.path.join(workdir, f"upload-{size}"), "wb") as f:
+                f.write(os.urandom(min(size, MB)) * (size // MB) + os.urandom(size % MB))
+        for direction in args.directions.split(","):
+            for size in sizes:
+                for connections in connection_counts:
+                    runs = [
+                        await run_case(args, direction, size, connections, workdir)
+                        for _ in range(args.repeat)
+                    ]
+                    result = sorted(runs, key=lambda run: run["mb_s"])[len(runs) // 2]
+                    print(" ".join(
+                        f"{value:>11.2f}" if isinstance(value, float) else f"{str(value):>11}"
+                        for value in (result[column] for column in columns)
+                    ))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
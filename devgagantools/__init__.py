@@ -6,14 +6,42 @@ import sys
 import os
 import pathlib
 import time
+import asyncio
+import inspect
 import logging
 import mimetypes
+from collections import deque
+from telethon.errors import FloodWaitError
 from telethon.tl.types import DocumentAttributeFilename
 from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait, MessageNotModified
 
 sys.path.insert(0, f"{pathlib.Path(__file__).parent.resolve()}")
 
-from spylib import upload_file, download_file
+from spylib import (
+    upload_file,
+    download_file,
+    stream_range,
+    download_small,
+    relay_file,
+    FileSink,
+    DownloadCache,
+    ClientPool,
+    run_io,
+    get_upload_cache,
+    close_sender_pools,
+    enable_process_pool,
+    enable_cdn,
+    persist_authorizations,
+    transfer_scheduler,
+    memory_budget,
+    add_metrics_hook,
+    remove_metrics_hook,
+    PrometheusMetrics,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    PRIORITY_HIGH,
+)
 
 class Timer:
     def __init__(self, time_between=1):  # 1 second for frequent updates
@@ -26,9 +54,14 @@ class Timer:
             return True
         return False
 
-def progress_bar_str(done, total, user_id):
+def progress_bar_str(done, total, user_id, speed=None, eta=None):
     percent = round(done/total*100, 2)
     strin = "♦" * (int(percent // 10)) + "◇" * (10 - int(percent // 10))
+    rate = ""
+    if speed is not None:
+        rate = f"│ **__Speed:__** {speed / (1024 * 1024):.2f} MB/s\n"
+    if eta is not None:
+        rate += f"│ **__ETA:__** {int(eta // 60)}m {int(eta % 60)}s\n"
     final = (
         f"╭──────────────────╮\n"
         f"│     **__Progress__**       \n"
@@ -36,6 +69,7 @@ def progress_bar_str(done, total, user_id):
         f"│ {strin}\n\n"
         f"│ **__Progress:__** {percent:.2f}%\n"
         f"│ **__Done:__** {done / (1024 * 1024):.2f} MB / {total / (1024 * 1024):.2f} MB\n"
+        f"{rate}"
         f"╰──────────────────╯\n"
         f"**__Powered by Team SPY__**"
     )
@@ -48,7 +82,138 @@ def human_readable_size(size, decimal_places=2):
         size /= 1024.0
     return f"{size:.{decimal_places}f} {unit}"
 
-async def fast_download(client, msg, reply=None, download_folder=None, progress_bar_function=None, name=None, user_id=None, fallback_client=None, chat_id=None):
+class ProgressTrack:
+    """
+    Progress of one transfer shown in one message. Transfers only store
+    their byte counts in it, the ProgressReporter decides when to edit.
+    """
+
+    def __init__(self, reporter, message, render, edit, args):
+        self.reporter = reporter
+        self.message = message
+        self.render = render
+        self.edit = edit
+        self.args = args
+        self.chat_id = getattr(message, 'chat_id', None) or getattr(getattr(message, 'chat', None), 'id', None)
+        self.done = 0
+        self.total = 0
+        self.text = None
+        self.edited_at = 0.0
+        self.dirty = False
+        self.closed = False
+        # (time, bytes done) samples over the last `reporter.window` seconds
+        self.samples = deque()
+        try:
+            parameters = inspect.signature(render).parameters
+            self.with_rate = 'speed' in parameters or any(
+                p.kind == p.VAR_KEYWORD for p in parameters.values()
+            )
+        except (TypeError, ValueError):
+            self.with_rate = False
+
+    def update(self, done, total):
+        self.done = done
+        self.total = total
+        self.dirty = True
+        now = time.monotonic()
+        if not self.samples or now - self.samples[-1][0] >= 0.5:
+            self.samples.append((now, done))
+            while len(self.samples) > 2 and now - self.samples[0][0] > self.reporter.window:
+                self.samples.popleft()
+
+    async def __call__(self, done, total):
+        # Usable as a transfer's progress_callback as it is
+        self.update(done, total)
+
+    @property
+    def speed(self):
+        if len(self.samples) < 2:
+            return None
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else None
+
+    @property
+    def eta(self):
+        speed = self.speed
+        return (self.total - self.done) / speed if speed else None
+
+    def close(self):
+        # The last update is still shown before the reporter lets go of it
+        self.closed = True
+
+
+class ProgressReporter:
+    """
+    Edits the progress messages of every transfer from one loop: at most one
+    edit per chat every `chat_interval` seconds, none when the text did not
+    change, and chats under FLOOD_WAIT are left alone until it is over.
+    """
+
+    def __init__(self, interval=1.0, chat_interval=3.0, window=10.0):
+        self.interval = interval
+        self.chat_interval = chat_interval
+        self.window = window
+        self.tracks = set()
+        self._chat_ready_at = {}
+        self._task = None
+
+    def track(self, message, render, edit=None, *args):
+        track = ProgressTrack(self, message, render, edit or message.edit, args)
+        self.tracks.add(track)
+        if not self._task or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return track
+
+    async def _run(self):
+        while self.tracks:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._flush()
+            except Exception as e:
+                logging.error(f"Progress reporting failed: {e}")
+
+    async def _flush(self):
+        now = time.monotonic()
+        chats = {}
+        for track in list(self.tracks):
+            if track.closed and not track.dirty:
+                self.tracks.discard(track)
+            elif track.dirty and self._chat_ready_at.get(track.chat_id, 0) <= now:
+                chats.setdefault(track.chat_id, []).append(track)
+        edits = []
+        for chat_id, tracks in chats.items():
+            # The message that waited longest gets the chat's next edit
+            for track in sorted(tracks, key=lambda t: t.edited_at):
+                track.dirty = False
+                if track.with_rate:
+                    text = track.render(track.done, track.total, *track.args, speed=track.speed, eta=track.eta)
+                else:
+                    text = track.render(track.done, track.total, *track.args)
+                if text != track.text:
+                    track.text = text
+                    track.edited_at = now
+                    self._chat_ready_at[chat_id] = now + self.chat_interval
+                    edits.append(self._edit(track, text))
+                    break
+        await asyncio.gather(*edits)
+
+    async def _edit(self, track, text):
+        try:
+            await track.edit(text)
+        except (FloodWait, FloodWaitError) as e:
+            seconds = getattr(e, 'value', None) or getattr(e, 'seconds', 0)
+            logging.warning(f"Progress edits in chat {track.chat_id} paused for {seconds}s")
+            self._chat_ready_at[track.chat_id] = time.monotonic() + seconds
+            track.dirty = True
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logging.error(f"Error updating progress: {e}")
+
+
+progress_reporter = ProgressReporter()
+
+async def fast_download(client, msg, reply=None, download_folder=None, progress_bar_function=None, name=None, user_id=None, fallback_client=None, chat_id=None, priority=PRIORITY_NORMAL, resume=False, cache=None, verify=False):
     """
     Download a file from a message with progress tracking and user-specific isolation.
     
@@ -62,10 +227,17 @@ async def fast_download(client, msg, reply=None, download_folder=None, progress_
         user_id: User identifier for isolation (optional)
         fallback_client: Telethon client for fallback messaging (optional)
         chat_id: Chat ID for fallback messaging (optional)
+        priority: PRIORITY_LOW, PRIORITY_NORMAL or PRIORITY_HIGH share of the connection budget
+        resume: Keep partial downloads and continue them on the next call (optional)
+        cache: DownloadCache shared between users, the file is linked from it, not with resume (optional)
+        verify: Check every part against Telegram's file hashes, refetching bad ones (optional)
         
     Returns:
         Tuple of (path to the downloaded file, document attributes)
     """
+    if cache and resume:
+        raise ValueError("resume can't be combined with cache, the cache downloads whole files")
+
     # Create a unique download ID
     timestamp = int(time.time())
     message_id = getattr(msg, 'id', 0)
@@ -79,25 +251,23 @@ async def fast_download(client, msg, reply=None, download_folder=None, progress_
         except AttributeError:
             user_id = f"unknown_{message_id}_{timestamp}"
     
-    # Set up progress tracking
-    timer = Timer()
-    
-    # Create progress callback
-    async def progress_callback(downloaded_bytes, total_bytes):
-        if reply and timer.can_send() and progress_bar_function:
-            data = progress_bar_function(downloaded_bytes, total_bytes, user_id)
-            try:
-                logging.info(f"Updating progress for user {user_id}: {data}")
-                await reply.edit_text(data, parse_mode=ParseMode.MARKDOWN)
-            except pyrogram.errors.MessageNotModified:
-                pass  # Ignore if the message content hasn't changed
-            except Exception as e:
-                logging.error(f"Pyrogram edit failed: {e}. Falling back to Telethon.")
-                if fallback_client and chat_id:
-                    try:
-                        await fallback_client.send_message(chat_id, data, parse_mode='md')
-                    except Exception as te:
-                        logging.error(f"Telethon fallback failed: {te}")
+    # Progress edits are batched and rate limited together with every other transfer
+    async def edit_progress(data):
+        try:
+            await reply.edit_text(data, parse_mode=ParseMode.MARKDOWN)
+        except (FloodWait, MessageNotModified):
+            raise
+        except Exception as e:
+            logging.error(f"Pyrogram edit failed: {e}. Falling back to Telethon.")
+            if fallback_client and chat_id:
+                try:
+                    await fallback_client.send_message(chat_id, data, parse_mode='md')
+                except Exception as te:
+                    logging.error(f"Telethon fallback failed: {te}")
+
+    progress_callback = None
+    if reply and progress_bar_function:
+        progress_callback = progress_reporter.track(reply, progress_bar_function, edit_progress, user_id)
 
     # Get file info
     file = msg.document
@@ -148,30 +318,98 @@ async def fast_download(client, msg, reply=None, download_folder=None, progress_
     # Log the download start
     logging.info(f"Downloading file to {download_location} (User: {user_id})")
     
+    sink = None
     try:
-        # Create the file and download
-        with open(download_location, "wb") as f:
-            await download_file(
-                client=client, 
-                location=file, 
-                out=f,
-                progress_callback=progress_callback if reply else None
+        if cache:
+            # Everyone asking for the same document shares one download
+            await cache.save_to(
+                client,
+                file,
+                download_location,
+                progress_callback=progress_callback,
+                priority=priority,
+                verify=verify,
             )
+            if verify and not cache.verified(file):
+                logging.warning(f"Could not verify every part of {download_location}")
+            logging.info(f"Download completed: {download_location}")
+            return download_location
+
+        # Parts are written straight into a preallocated temporary file next to the
+        # final one, which is renamed into place once the download is complete
+        sink = await run_io(FileSink, download_location, file.size, resume)
+        await download_file(
+            client=client, 
+            location=file, 
+            out=sink,
+            progress_callback=progress_callback,
+            priority=priority,
+            resume=resume,
+            verify=verify
+        )
+        await run_io(sink.commit)
+        if verify and not sink.verified:
+            logging.warning(f"Could not verify every part of {download_location}")
         
         logging.info(f"Download completed: {download_location}")
         return download_location
     
     except Exception as e:
         logging.error(f"Download failed: {e}")
-        # Clean up partial file if it exists
-        if os.path.exists(download_location):
+        # Clean up the partial file, unless it is kept to be resumed
+        if sink:
             try:
-                os.remove(download_location)
+                sink.close(keep=resume)
             except:
                 pass
         raise
+    finally:
+        if progress_callback:
+            progress_callback.close()
+
+async def fast_relay(client, msg, reply=None, name=None, progress_bar_function=None, user_id=None, upload_client=None, priority=PRIORITY_NORMAL):
+    """
+    Re-upload the file of a message without storing it on disk.
+    
+    Args:
+        client: Telegram client the message was received on
+        msg: Message containing the file
+        reply: Reply message for progress updates
+        name: Custom filename (optional)
+        progress_bar_function: Function to format progress
+        user_id: User identifier for logging (optional)
+        upload_client: Telegram client to upload with, defaults to client (optional)
+        priority: PRIORITY_LOW, PRIORITY_NORMAL or PRIORITY_HIGH share of the connection budget
+        
+    Returns:
+        Uploaded file object
+    """
+    progress_callback = None
+    if reply and progress_bar_function:
+        progress_callback = progress_reporter.track(reply, progress_bar_function)
+    
+    logging.info(f"Relaying file from message {getattr(msg, 'id', None)} (User: {user_id})")
+    try:
+        # Parts go straight from the download into the upload as they arrive
+        the_file = await relay_file(
+            client=client,
+            location=msg.document,
+            name=name,
+            progress_callback=progress_callback,
+            priority=priority,
+            upload_client=upload_client
+        )
+        logging.info(f"Relay completed: {the_file.name}")
+        return the_file
+    
+    except Exception as e:
+        logging.error(f"Relay failed: {e}")
+        raise
+    finally:
+        if progress_callback:
+            progress_callback.close()
 
-async def fast_upload(client, file_location, reply=None, name=None, progress_bar_function=None, user_id=None):
+async def fast_upload(client, file_location, reply=None, name=None, progress_bar_function=None, user_id=None, priority=PRIORITY_NORMAL, reuse=True):
     """
     Upload a file with progress tracking and user-specific naming.
     
@@ -182,6 +420,8 @@ async def fast_upload(client, file_location, reply=None, name=None, progress_bar
         name: Custom filename (optional)
         progress_bar_function: Function to format progress
         user_id: User identifier for filename prefix (optional)
+        priority: PRIORITY_LOW, PRIORITY_NORMAL or PRIORITY_HIGH share of the connection budget
+        reuse: Return the handle of a recent upload of the same unchanged file (optional)
         
     Returns:
         Uploaded file object
@@ -193,9 +433,6 @@ async def fast_upload(client, file_location, reply=None, name=None, progress_bar
     # Create a unique identifier for this upload
     timestamp = int(time.time())
     
-    # Set up progress tracking
-    timer = Timer()
-    
     # Determine filename with proper isolation
     if name is None:
         # Extract base filename
@@ -216,31 +453,28 @@ async def fast_upload(client, file_location, reply=None, name=None, progress_bar
     # Log upload start
     logging.info(f"Uploading file {file_location} as {name} (User: {user_id})")
     
-    # Create progress callback
-    async def progress_callback(uploaded_bytes, total_bytes):
-        if timer.can_send() and progress_bar_function:
-            data = progress_bar_function(uploaded_bytes, total_bytes)
-            try:
-                await reply.edit(f"{data}")
-            except Exception as e:
-                logging.error(f"Error updating progress: {e}")
+    # Progress edits are batched and rate limited together with every other transfer
+    progress_callback = None
+    if reply and progress_bar_function:
+        progress_callback = progress_reporter.track(reply, progress_bar_function)
     
     try:
         # Upload the file
-        if reply:
-            with open(file_location, "rb") as f:
-                the_file = await upload_file(
-                    client=client,
-                    file=f,
-                    name=name,
-                    progress_callback=progress_callback
-                )
+        if reuse:
+            the_file = await get_upload_cache(client).upload(
+                file_location,
+                name=name,
+                progress_callback=progress_callback,
+                priority=priority
+            )
         else:
             with open(file_location, "rb") as f:
                 the_file = await upload_file(
                     client=client,
                     file=f,
-                    name=name
+                    name=name,
+                    progress_callback=progress_callback,
+                    priority=priority
                 )
                 
         logging.info(f"Upload completed: {name}")
@@ -249,3 +483,102 @@ async def fast_upload(client, file_location, reply=None, name=None, progress_bar
     except Exception as e:
         logging.error(f"Upload failed: {e}")
         raise
+    finally:
+        if progress_callback:
+            progress_callback.close()
+
+async def _transfer_many(items, transfer, concurrency):
+    # A fixed number of workers pull items one at a time, so even a whole channel's
+    # history is never turned into tasks all at once
+    if hasattr(items, '__aiter__'):
+        iterator = items.__aiter__()
+    else:
+        iterator = iter(items)
+    lock = asyncio.Lock()
+    results = asyncio.Queue()
+
+    async def next_item():
+        async with lock:
+            if hasattr(iterator, '__anext__'):
+                return await iterator.__anext__()
+            try:
+                return next(iterator)
+            except StopIteration:
+                raise StopAsyncIteration
+
+    async def worker():
+        try:
+            while True:
+                try:
+                    item = await next_item()
+                except StopAsyncIteration:
+                    return
+                try:
+                    result = await transfer(item)
+                except Exception as e:
+                    result = e
+                await results.put((item, result))
+        except Exception as e:
+            # Reading the next item failed, no item to report it for
+            await results.put((None, e))
+        finally:
+            await results.put(None)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    running = len(workers)
+    try:
+        while running:
+            result = await results.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+    finally:
+        for task in workers:
+            task.cancel()
+
+async def fast_download_many(client, messages, concurrency=8, **kwargs):
+    """
+    Download the files of many messages, a few at a time.
+    
+    Every download borrows its connections from the same per-DC pool, so small
+    files reuse the connections the previous ones were done with instead of
+    setting up new ones.
+    
+    Args:
+        client: Telegram client (Telethon)
+        messages: Messages containing the files, a list or an async iterator (e.g. client.iter_messages)
+        concurrency: Number of files downloaded at the same time
+        **kwargs: Passed on to fast_download for every message
+        
+    Yields:
+        Tuples of (message, path to the downloaded file or the exception it failed with) as each completes
+    """
+    async def download(msg):
+        return await fast_download(client, msg, **kwargs)
+
+    async for result in _transfer_many(messages, download, concurrency):
+        yield result
+
+async def fast_upload_many(client, file_locations, concurrency=8, **kwargs):
+    """
+    Upload many files, a few at a time.
+    
+    Every upload borrows its connections from the same pool, so small files
+    reuse the connections the previous ones were done with instead of setting
+    up new ones.
+    
+    Args:
+        client: Telegram client
+        file_locations: Paths of the files to upload, a list or an async iterator
+        concurrency: Number of files uploaded at the same time
+        **kwargs: Passed on to fast_upload for every file
+        
+    Yields:
+        Tuples of (path, uploaded file object or the exception it failed with) as each completes
+    """
+    async def upload(file_location):
+        return await fast_upload(client, file_location, **kwargs)
+
+    async for result in _transfer_many(file_locations, upload, concurrency):
+        yield result
@@ -4,34 +4,68 @@
 > Editted and updated by Gagan - https://github.com/devgagan
 """
 import asyncio
+import base64
+import bisect
+import concurrent.futures
+import copy
+import functools
 import hashlib
 import inspect
+import itertools
+import json
 import logging
 import math
+import multiprocessing
 import os
-from collections import defaultdict
+import shutil
+import time
+import weakref
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import (
     AsyncGenerator,
     Awaitable,
     BinaryIO,
+    Callable,
     DefaultDict,
+    Deque,
+    Dict,
+    Iterable,
     List,
     Optional,
+    Set,
     Tuple,
     Union,
 )
 
 from telethon import TelegramClient, helpers, utils
-from telethon.crypto import AuthKey
+from telethon.crypto import AESModeCTR, AuthKey
+from telethon.errors import (
+    AuthKeyNotFound,
+    CdnFileTamperedError,
+    FileMigrateError,
+    FloodError,
+    RPCError,
+    SecurityError,
+    ServerError,
+    TimedOutError,
+    UnauthorizedError,
+)
+from telethon.extensions import BinaryReader
 from telethon.network import MTProtoSender
 from telethon.tl.alltlobjects import LAYER
-from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions import InvokeWithLayerRequest, PingRequest
 from telethon.tl.functions.auth import (
     ExportAuthorizationRequest,
     ImportAuthorizationRequest,
 )
+from telethon.tl.functions.users import GetUsersRequest
 from telethon.tl.functions.upload import (
+    GetCdnFileHashesRequest,
+    GetCdnFileRequest,
+    GetFileHashesRequest,
     GetFileRequest,
+    ReuploadCdnFileRequest,
     SaveBigFilePartRequest,
     SaveFilePartRequest,
 )
@@ -43,14 +77,24 @@ from telethon.tl.types import (
     InputFileLocation,
     InputPeerPhotoFileLocation,
     InputPhotoFileLocation,
+    InputUserSelf,
     TypeInputFile,
 )
+from telethon.tl.types.upload import CdnFileReuploadNeeded, FileCdnRedirect
+
+try:
+    import tgcrypto
+except ImportError:
+    tgcrypto = None
 
 # Remove the global filename variable
 # filename = ""  # DELETE THIS LINE
 
 log: logging.Logger = logging.getLogger("FastTelethon")
 
+# Disk reads, writes and hashing run here so they never block the MTProto senders
+io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="FastTelethon-io")
+
 TypeLocation = Union[
     Document,
     InputDocumentFileLocation,
@@ -59,87 +103,1014 @@ TypeLocation = Union[
     InputPhotoFileLocation,
 ]
 
+# Hooks get every measurement as (name, value, labels). With none registered the hot
+# paths only pay for checking the list.
+MetricsHook = Callable[[str, float, Dict[str, str]], None]
+metrics_hooks: List[MetricsHook] = []
+
+
+def add_metrics_hook(hook: MetricsHook) -> MetricsHook:
+    metrics_hooks.append(hook)
+    return hook
+
+
+def remove_metrics_hook(hook: MetricsHook) -> None:
+    metrics_hooks.remove(hook)
+
+
+def _emit(name: str, value: float, **labels) -> None:
+    for hook in metrics_hooks:
+        try:
+            hook(name, value, labels)
+        except Exception:
+            log.exception(f"Metrics hook {hook!r} failed")
+
+
+class PrometheusMetrics:
+    """
+    Metrics hook that adds the measurements up into counters and summaries
+    and renders them in the Prometheus text exposition format. Labels that
+    identify single transfers or senders are dropped by default, they would
+    make a new series for every file.
+    """
+
+    TYPES = {
+        "part_bytes": ("counter", "Bytes transferred in parts"),
+        "part_seconds": ("summary", "Time a part request took"),
+        "part_retries": ("counter", "Parts sent again after an error"),
+        "flood_wait_seconds": ("counter", "Time transfers were paused by FLOOD_WAIT"),
+        "connect_seconds": ("summary", "Time it took to connect a sender"),
+        "queue_seconds": ("summary", "Time transfers waited for connections"),
+        "transfer_seconds": ("summary", "Time whole transfers took"),
+        "disk_wait_seconds": ("summary", "Time transfers were blocked on disk"),
+        "memory_wait_seconds": ("summary", "Time transfers waited for the memory budget"),
+    }
+
+    prefix: str
+    drop_labels: Set[str]
+
+    def __init__(
+        self,
+        prefix: str = "fasttelethon",
+        drop_labels: Iterable[str] = ("transfer", "sender"),
+    ) -> None:
+        self.prefix = prefix
+        self.drop_labels = set(drop_labels)
+        self._series: DefaultDict[str, Dict[Tuple[Tuple[str, str], ...], List[float]]] = (
+            defaultdict(dict)
+        )
+
+    def __call__(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        key = tuple(
+            sorted((k, str(v)) for k, v in labels.items() if k not in self.drop_labels)
+        )
+        series = self._series[name].get(key)
+        if series is None:
+            series = self._series[name][key] = [0.0, 0]
+        series[0] += value
+        series[1] += 1
+
+    @staticmethod
+    def _labels(key: Tuple[Tuple[str, str], ...]) -> str:
+        if not key:
+            return ""
+        escaped = (
+            (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in key
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self._series.items()):
+            kind, help_text = self.TYPES.get(name, ("counter", name))
+            metric = f"{self.prefix}_{name}"
+            if kind == "counter":
+                # The text format has no families, HELP and TYPE name the sample itself
+                metric = f"{metric}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for key, (total, count) in sorted(series.items()):
+                labels = self._labels(key)
+                if kind == "summary":
+                    lines.append(f"{metric}_sum{labels} {total}")
+                    lines.append(f"{metric}_count{labels} {count}")
+                else:
+                    lines.append(f"{metric}{labels} {total}")
+        return "\n".join(lines) + "\n"
+
+
+class AuthorizationCache:
+    """
+    Authorization keys imported into foreign DCs, so that the export/import
+    round-trips happen once per client and DC rather than once per transfer.
+    Keys can optionally be persisted next to the session file.
+    """
+
+    keys: Dict[int, AuthKey]
+    path: Optional[str]
+
+    def __init__(self, client: TelegramClient) -> None:
+        # Only a weak reference, auth_caches must not keep the client alive
+        self._client = weakref.ref(client)
+        self.keys = {}
+        self.path = None
+        # Keys loaded from disk may have been revoked since, they are checked on first use
+        self._unverified = set()
+        self._locks: DefaultDict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    @property
+    def client(self) -> Optional[TelegramClient]:
+        return self._client()
+
+    def persist_to(self, path: Optional[str] = None) -> None:
+        if path is None:
+            session_file = getattr(self.client.session, "filename", None)
+            if not session_file:
+                raise ValueError(
+                    "The session is not stored on disk, pass a path to persist authorizations"
+                )
+            path = f"{os.path.splitext(session_file)[0]}.dcauth.json"
+        self.path = path
+        self._load()
+
+    def forget(self, dc_id: int, auth_key: Optional[AuthKey] = None) -> None:
+        # With a key, only that key is dropped, a newer export may have replaced it already
+        if auth_key is not None and self.keys.get(dc_id) != auth_key:
+            return
+        self.keys.pop(dc_id, None)
+        self._unverified.discard(dc_id)
+        self._save()
+
+    async def create_sender(
+        self,
+        dc_id: int,
+        connect: Callable[[Optional[AuthKey]], Awaitable[MTProtoSender]],
+    ) -> MTProtoSender:
+        key = self.keys.get(dc_id)
+        if key and dc_id not in self._unverified:
+            return await connect(key)
+
+        # Only one export per DC may be in flight, everyone else waits for its key
+        async with self._locks[dc_id]:
+            key = self.keys.get(dc_id)
+            if key and dc_id not in self._unverified:
+                return await connect(key)
+            if key:
+                sender = await connect(key)
+                try:
+                    await self._invoke(sender, GetUsersRequest([InputUserSelf()]))
+                except (UnauthorizedError, AuthKeyNotFound) as e:
+                    log.info(f"Stored authorization for DC {dc_id} is no longer valid: {e!r}")
+                    await sender.disconnect()
+                    self.forget(dc_id)
+                except BaseException:
+                    await sender.disconnect()
+                    raise
+                else:
+                    self._unverified.discard(dc_id)
+                    return sender
+
+            sender = await connect(None)
+            try:
+                auth = await self.client(ExportAuthorizationRequest(dc_id))
+                await self._invoke(
+                    sender, ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+                )
+            except BaseException:
+                await sender.disconnect()
+                raise
+            self.keys[dc_id] = sender.auth_key
+            self._save()
+            return sender
+
+    async def _invoke(self, sender: MTProtoSender, query) -> None:
+        # A copy, the client's own init request is shared by every concurrent export
+        init_request = copy.copy(self.client._init_request)
+        init_request.query = query
+        await sender.send(InvokeWithLayerRequest(LAYER, init_request))
+
+    def _owner(self) -> Optional[int]:
+        auth_key = self.client.session.auth_key
+        return auth_key.key_id if auth_key else None
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read stored authorizations from {self.path}: {e!r}")
+            return
+        # Keys exported by another account are useless, and so are keys from a logged out session
+        if data.get("owner") != self._owner():
+            return
+        for dc_id, key in data.get("keys", {}).items():
+            dc_id = int(dc_id)
+            if dc_id not in self.keys:
+                self.keys[dc_id] = AuthKey(base64.b64decode(key))
+                self._unverified.add(dc_id)
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        data = {
+            "owner": self._owner(),
+            "keys": {
+                str(dc_id): base64.b64encode(key.key).decode()
+                for dc_id, key in self.keys.items()
+            },
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Could not store authorizations to {self.path}: {e!r}")
+
+
+auth_caches: "weakref.WeakKeyDictionary[TelegramClient, AuthorizationCache]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_auth_cache(client: TelegramClient) -> AuthorizationCache:
+    if client not in auth_caches:
+        auth_caches[client] = AuthorizationCache(client)
+    return auth_caches[client]
+
+
+def persist_authorizations(client: TelegramClient, path: Optional[str] = None) -> None:
+    get_auth_cache(client).persist_to(path)
+
+
+class SenderPool:
+    """
+    Long-lived MTProtoSender connections to one DC, shared by every transfer
+    of a client. Senders are borrowed with `acquire` and handed back with
+    `release` instead of being disconnected after each file.
+    """
+
+    dc_id: int
+    max_size: int
+    idle_timeout: float
+    health_check_after: float
+    size: int
+    idle: List[Tuple[MTProtoSender, float]]
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        dc_id: int,
+        max_size: int = 20,
+        idle_timeout: float = 60.0,
+        health_check_after: float = 15.0,
+    ) -> None:
+        # Only a weak reference, sender_pools must not keep the client alive
+        self._client = weakref.ref(client)
+        self.loop = client.loop
+        self.dc_id = dc_id
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        # Number of senders owned by the pool, both idle and borrowed
+        self.size = 0
+        self.idle = []
+        self._waiters: List[asyncio.Future] = []
+        self._reaper: Optional[asyncio.Task] = None
+
+    @property
+    def client(self) -> Optional[TelegramClient]:
+        return self._client()
+
+    async def acquire(
+        self, create: Callable[[], Awaitable[MTProtoSender]], wait: bool = True
+    ) -> Optional[MTProtoSender]:
+        while True:
+            while self.idle:
+                # Most recently returned first, it is the least likely to be stale
+                sender, returned_at = self.idle.pop()
+                if await self._is_healthy(sender, returned_at):
+                    return sender
+                self._discard(sender)
+            if self.size < self.max_size:
+                self.size += 1
+                try:
+                    return await create()
+                except BaseException:
+                    self.size -= 1
+                    self._wake()
+                    raise
+            if not wait:
+                return None
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, sender: MTProtoSender, healthy: bool = True) -> None:
+        if healthy and sender.is_connected():
+            self.idle.append((sender, time.monotonic()))
+            if not self._reaper or self._reaper.done():
+                self._reaper = self.loop.create_task(self._reap())
+        else:
+            self._discard(sender)
+        self._wake()
+
+    async def close(self) -> None:
+        if self._reaper:
+            self._reaper.cancel()
+        idle, self.idle = self.idle, []
+        self.size -= len(idle)
+        await asyncio.gather(*[sender.disconnect() for sender, _ in idle])
+
+    def drop(self, auth_key: Optional[AuthKey]) -> None:
+        # Idle senders still using a revoked authorization would only fail again
+        dropped = [entry for entry in self.idle if entry[0].auth_key == auth_key]
+        self.idle = [entry for entry in self.idle if entry[0].auth_key != auth_key]
+        for sender, _ in dropped:
+            self._discard(sender)
+        if dropped:
+            self._wake()
+
+    async def _is_healthy(self, sender: MTProtoSender, returned_at: float) -> bool:
+        if not sender.is_connected():
+            return False
+        if time.monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            await asyncio.wait_for(
+                self.client._call(
+                    sender, PingRequest(ping_id=helpers.generate_random_long())
+                ),
+                timeout=5,
+            )
+        except Exception as e:
+            log.debug(f"Dropping unhealthy pooled sender for DC {self.dc_id}: {e!r}")
+            return False
+        return True
+
+    def _discard(self, sender: MTProtoSender) -> None:
+        self.size -= 1
+        self.loop.create_task(sender.disconnect())
+
+    def _wake(self) -> None:
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def _reap(self) -> None:
+        while self.idle:
+            await asyncio.sleep(self.idle_timeout / 2)
+            deadline = time.monotonic() - self.idle_timeout
+            expired = [entry for entry in self.idle if entry[1] < deadline]
+            self.idle = [entry for entry in self.idle if entry[1] >= deadline]
+            for sender, _ in expired:
+                self._discard(sender)
+            if expired:
+                self._wake()
+
+
+sender_pools: "weakref.WeakKeyDictionary[TelegramClient, Dict[int, SenderPool]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_sender_pool(client: TelegramClient, dc_id: int) -> SenderPool:
+    pools = sender_pools.setdefault(client, {})
+    if dc_id not in pools:
+        pools[dc_id] = SenderPool(client, dc_id)
+    return pools[dc_id]
+
+
+async def close_sender_pools(client: TelegramClient) -> None:
+    pools = sender_pools.pop(client, {})
+    await asyncio.gather(*[pool.close() for pool in pools.values()])
+
+
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 2
+PRIORITY_HIGH = 4
+
+
+class TransferTicket:
+    scheduler: "TransferScheduler"
+    client: TelegramClient
+    dc_id: int
+    wanted: int
+    size: int
+    priority: int
+    granted: int
+
+    def __init__(
+        self,
+        scheduler: "TransferScheduler",
+        client: TelegramClient,
+        dc_id: int,
+        wanted: int,
+        size: int,
+        priority: int,
+        seq: int,
+    ) -> None:
+        self.scheduler = scheduler
+        self.client = client
+        self.dc_id = dc_id
+        self.wanted = max(1, wanted)
+        self.size = size
+        self.priority = priority
+        self.seq = seq
+        self.granted = 0
+        self.changed = asyncio.Event()
+
+    def release(self) -> None:
+        self.scheduler._remove(self)
+
+
+class TransferScheduler:
+    """
+    Process-wide connection budget shared by every transfer. Each transfer gets
+    at least one connection once admitted, the rest of the budget is spread
+    by priority class and rebalanced whenever a transfer starts or finishes.
+    """
+
+    per_dc: int
+    per_account: int
+    tickets: List[TransferTicket]
+
+    def __init__(self, per_dc: int = 20, per_account: int = 40) -> None:
+        # per_dc limits the connections of one account to one DC, per_account all of its DCs
+        self.per_dc = per_dc
+        self.per_account = per_account
+        self.tickets = []
+        self._seq = itertools.count()
+
+    async def admit(
+        self,
+        client: TelegramClient,
+        dc_id: int,
+        wanted: int,
+        size: int,
+        priority: int = PRIORITY_NORMAL,
+    ) -> TransferTicket:
+        ticket = TransferTicket(
+            self, client, dc_id, wanted, size, priority, next(self._seq)
+        )
+        self.tickets.append(ticket)
+        self._rebalance()
+        try:
+            while not ticket.granted:
+                ticket.changed.clear()
+                await ticket.changed.wait()
+        except BaseException:
+            self._remove(ticket)
+            raise
+        return ticket
+
+    def _remove(self, ticket: TransferTicket) -> None:
+        if ticket in self.tickets:
+            self.tickets.remove(ticket)
+            self._rebalance()
+
+    def _rebalance(self) -> None:
+        per_dc: DefaultDict[Tuple[int, int], int] = defaultdict(int)
+        per_account: DefaultDict[int, int] = defaultdict(int)
+        shares = {ticket: 0 for ticket in self.tickets}
+
+        def grant(ticket: TransferTicket) -> bool:
+            dc_key = (id(ticket.client), ticket.dc_id)
+            if (
+                per_dc[dc_key] >= self.per_dc
+                or per_account[id(ticket.client)] >= self.per_account
+            ):
+                return False
+            per_dc[dc_key] += 1
+            per_account[id(ticket.client)] += 1
+            shares[ticket] += 1
+            return True
+
+        # Running transfers keep their first connection, then waiting ones are admitted
+        # by priority class with small files first
+        order = sorted(
+            self.tickets,
+            key=lambda t: (not t.granted, -t.priority, t.size, t.seq),
+        )
+        for ticket in order:
+            grant(ticket)
+        hungry = [ticket for ticket in order if shares[ticket]]
+        while hungry:
+            ticket = min(hungry, key=lambda t: shares[t] / t.priority)
+            if shares[ticket] >= ticket.wanted or not grant(ticket):
+                hungry.remove(ticket)
+
+        for ticket, share in shares.items():
+            if ticket.granted != share:
+                ticket.granted = share
+                ticket.changed.set()
+
+
+transfer_scheduler = TransferScheduler()
+
+
+class MemoryBudget:
+    """
+    Process-wide cap on the part data transfers hold: room in the download
+    reorder buffers and upload parts waiting for or in flight. Transfers
+    wait for room in the order they asked, instead of growing past the
+    limit under bursts.
+    """
+
+    limit: int
+    used: int
+
+    def __init__(self, limit: int = 256 * 1024 * 1024) -> None:
+        self.limit = limit
+        self.used = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    def fits(self, size: int) -> bool:
+        # Anything fits into an empty budget, however small the limit
+        return not self.used or self.used + size <= self.limit
+
+    def force(self, size: int) -> None:
+        self.used += size
+
+    async def reserve(self, size: int) -> None:
+        if not self._waiters and self.fits(size):
+            self.used += size
+            return
+        waiter = (size, asyncio.get_event_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except BaseException:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # Got the room just as it was cancelled
+                self.release(size)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, size: int) -> None:
+        self.used -= size
+        while self._waiters and self.fits(self._waiters[0][0]):
+            size, future = self._waiters.popleft()
+            if not future.done():
+                self.used += size
+                future.set_result(None)
+
+
+memory_budget = MemoryBudget()
+
 
 class DownloadSender:
     client: TelegramClient
     sender: MTProtoSender
-    request: GetFileRequest
-    remaining: int
-    stride: int
+    pool: SenderPool
+    file: TypeLocation
+    part_size: int
+    workers: int
+    retired: bool
+    broken: bool
+    released: bool
+    rtt: float
 
     def __init__(
         self,
         client: TelegramClient,
         sender: MTProtoSender,
+        pool: SenderPool,
         file: TypeLocation,
-        offset: int,
-        limit: int,
-        stride: int,
-        count: int,
+        part_size: int,
+        cdn: Optional["CdnSession"] = None,
+        cdn_supported: bool = True,
+        hashes: Optional["PartHashes"] = None,
     ) -> None:
         self.sender = sender
         self.client = client
-        self.request = GetFileRequest(file, offset=offset, limit=limit)
-        self.stride = stride
-        self.remaining = count
+        self.pool = pool
+        self.file = file
+        self.part_size = part_size
+        # Set once the file was redirected to a CDN DC, which this sender is connected to
+        self.cdn = cdn
+        self.cdn_supported = cdn_supported
+        self.hashes = hashes
+        # Workers running on this connection, whether it has been taken away, whether it
+        # failed and whether it already went back to its pool
+        self.workers = 0
+        self.retired = False
+        self.broken = False
+        self.released = False
+        # Smoothed time a request takes on this connection
+        self.rtt = 0.0
 
-    async def next(self) -> Optional[bytes]:
-        if not self.remaining:
-            return None
-        result = await self.client._call(self.sender, self.request)
-        self.remaining -= 1
-        self.request.offset += self.stride
+    async def next(self, index: int) -> bytes:
+        if self.cdn:
+            return await self.cdn.get(
+                self.sender, index * self.part_size, self.part_size
+            )
+        # Each part gets its own request, several of them can be in flight at once
+        request = GetFileRequest(
+            self.file,
+            offset=index * self.part_size,
+            limit=self.part_size,
+            cdn_supported=self.cdn_supported,
+        )
+        # FLOOD_WAITs are handled by the transferrer, which can keep the other senders busy
+        result = await self.client._call(self.sender, request, flood_sleep_threshold=0)
+        if isinstance(result, FileCdnRedirect):
+            raise CdnRedirect(result)
+        if self.hashes:
+            await self.hashes.verify(
+                self.sender, index * self.part_size, self.part_size, result.bytes
+            )
         return result.bytes
 
     def disconnect(self) -> Awaitable[None]:
         return self.sender.disconnect()
 
 
+class CdnRedirect(Exception):
+    def __init__(self, redirect: FileCdnRedirect) -> None:
+        super().__init__(f"File redirected to CDN DC {redirect.dc_id}")
+        self.redirect = redirect
+
+
+async def _call_on_dc(client: TelegramClient, dc_id: int, request):
+    if dc_id == client.session.dc_id:
+        return await client._call(client._sender, request)
+    transferrer = ParallelTransferrer(client, dc_id)
+    sender = await transferrer.pool.acquire(transferrer._create_sender)
+    healthy = False
+    try:
+        result = await client._call(sender, request)
+        healthy = True
+        return result
+    except RPCError:
+        healthy = True
+        raise
+    finally:
+        transferrer.pool.release(sender, healthy)
+
+
+class CdnSession:
+    """
+    A file the origin DC redirected to a CDN DC. Parts come from the CDN
+    encrypted with AES-256-CTR under a key only the origin hands out, every
+    part is decrypted on its own from its offset and checked against the
+    SHA-256 hashes the origin keeps for the file.
+    """
+
+    client: TelegramClient
+    origin_dc: int
+    dc_id: int
+
+    def __init__(
+        self, client: TelegramClient, origin_dc: int, redirect: FileCdnRedirect
+    ) -> None:
+        self.client = client
+        self.origin_dc = origin_dc
+        self.dc_id = redirect.dc_id
+        self._token = redirect.file_token
+        self._key = redirect.encryption_key
+        self._iv = redirect.encryption_iv
+        self.hashes = PartHashes(self._fetch_hashes, redirect.file_hashes)
+        self._reupload_lock = asyncio.Lock()
+
+    def _wrap(self, request):
+        # CDN DCs get a fresh connection without authorization, which must be initialized
+        init_request = copy.copy(self.client._init_request)
+        init_request.query = request
+        return InvokeWithLayerRequest(LAYER, init_request)
+
+    def decrypt(self, offset: int, data: bytes) -> bytes:
+        # The counter of the part's first block is its offset in 16 byte blocks
+        iv = self._iv[:12] + (offset // 16).to_bytes(4, "big")
+        if tgcrypto:
+            return tgcrypto.ctr256_decrypt(data, self._key, bytearray(iv), bytearray(1))
+        return AESModeCTR(self._key, iv).decrypt(data)
+
+    async def get(self, sender: MTProtoSender, offset: int, limit: int) -> bytes:
+        while True:
+            result = await self.client._call(
+                sender,
+                self._wrap(GetCdnFileRequest(self._token, offset, limit)),
+                flood_sleep_threshold=0,
+            )
+            if not isinstance(result, CdnFileReuploadNeeded):
+                break
+            await self._reupload(result.request_token)
+        data = await run_io(self.decrypt, offset, result.bytes)
+        try:
+            verified = await self.hashes.verify(sender, offset, limit, data)
+        except PartHashMismatch:
+            verified = False
+        # Parts from a CDN are only ever used once they are checked
+        if not verified:
+            raise CdnFileTamperedError()
+        return data
+
+    async def _reupload(self, request_token: bytes) -> None:
+        # Parts asking at the same time only need the file to be uploaded to the CDN once
+        async with self._reupload_lock:
+            hashes = await _call_on_dc(
+                self.client,
+                self.origin_dc,
+                ReuploadCdnFileRequest(self._token, request_token),
+            )
+            self.hashes.add(hashes)
+
+    async def _fetch_hashes(self, sender: MTProtoSender, offset: int) -> list:
+        # Only the origin DC knows the hashes, the CDN could lie about them
+        return await _call_on_dc(
+            self.client, self.origin_dc, GetCdnFileHashesRequest(self._token, offset)
+        )
+
+
+class PartHashMismatch(Exception):
+    def __init__(self, offset: int) -> None:
+        super().__init__(f"Data at offset {offset} does not match its SHA-256 hash")
+        self.offset = offset
+
+
+class PartHashes:
+    """
+    The SHA-256 hashes Telegram keeps for every range of a file, fetched as
+    the parts that need them arrive. Parts are hashed on the I/O threads.
+    Parts that no hashes could be found for are counted in `unverified`.
+    """
+
+    unverified: int
+
+    def __init__(
+        self,
+        fetch: Callable[[Optional[MTProtoSender], int], Awaitable[list]],
+        hashes: Iterable = (),
+    ) -> None:
+        self._fetch = fetch
+        self._hashes = {}
+        self._lock = asyncio.Lock()
+        self._available = True
+        self.unverified = 0
+        self.add(hashes)
+
+    def add(self, hashes: Iterable) -> None:
+        self._hashes.update((h.offset, h) for h in hashes)
+
+    async def _hash(self, sender: Optional[MTProtoSender], offset: int):
+        if offset not in self._hashes and self._available:
+            async with self._lock:
+                if offset not in self._hashes and self._available:
+                    try:
+                        hashes = await self._fetch(sender, offset)
+                    except FloodError:
+                        raise
+                    except RPCError as e:
+                        # Not every location has hashes, the download goes on without them
+                        log.info(f"No file hashes to check parts against: {e!r}")
+                        self._available = False
+                        return None
+                    self.add(hashes)
+        return self._hashes.get(offset)
+
+    async def verify(
+        self, sender: Optional[MTProtoSender], offset: int, limit: int, data: bytes
+    ) -> bool:
+        hashes = []
+        position, end = offset, offset + len(data)
+        while position < end:
+            h = await self._hash(sender, position)
+            # A full part that ends inside a hashed range can't be checked on its own. A
+            # short one must be the end of the file, or it was cut off.
+            if not h or (position + h.limit > end and len(data) == limit):
+                self.unverified += 1
+                return False
+            hashes.append(h)
+            position += h.limit
+        if not await run_io(_hashes_match, offset, data, hashes):
+            raise PartHashMismatch(offset)
+        return True
+
+
+def _hashes_match(offset: int, data: bytes, hashes: list) -> bool:
+    view = memoryview(data)
+    return all(
+        h.offset - offset + h.limit <= len(data)
+        and hashlib.sha256(view[h.offset - offset : h.offset - offset + h.limit]).digest()
+        == h.hash
+        for h in hashes
+    )
+
+
 class UploadSender:
     client: TelegramClient
     sender: MTProtoSender
-    request: Union[SaveFilePartRequest, SaveBigFilePartRequest]
+    pool: SenderPool
+    file_id: int
     part_count: int
-    stride: int
-    previous: Optional[asyncio.Task]
-    loop: asyncio.AbstractEventLoop
+    big: bool
+    workers: int
+    slots: int
+    retired: bool
+    broken: bool
+    released: bool
+    rtt: float
 
     def __init__(
         self,
         client: TelegramClient,
         sender: MTProtoSender,
+        pool: SenderPool,
         file_id: int,
         part_count: int,
         big: bool,
-        index: int,
-        stride: int,
-        loop: asyncio.AbstractEventLoop,
     ) -> None:
         self.client = client
         self.sender = sender
+        self.pool = pool
+        self.file_id = file_id
         self.part_count = part_count
-        if big:
-            self.request = SaveBigFilePartRequest(file_id, index, part_count, b"")
+        self.big = big
+        # Parts in flight on this connection, how many it may carry at once, whether it
+        # has been taken away, whether it failed and whether it already went back to its pool
+        self.workers = 0
+        self.slots = 0
+        self.retired = False
+        self.broken = False
+        self.released = False
+        # Smoothed time a request takes on this connection
+        self.rtt = 0.0
+
+    async def next(self, index: int, data: bytes) -> None:
+        if self.big:
+            request = SaveBigFilePartRequest(self.file_id, index, self.part_count, data)
+        else:
+            request = SaveFilePartRequest(self.file_id, index, data)
+        await self.client._call(self.sender, request, flood_sleep_threshold=0)
+
+    def disconnect(self) -> Awaitable[None]:
+        return self.sender.disconnect()
+
+
+# Connections and requests in flight that worked best for the last transfer on a DC. No
+# connection count means the last transfer never found a ceiling below its own maximum.
+dc_tuning: Dict[int, Tuple[Optional[int], int]] = {}
+
+
+class TransferTuner:
+    """
+    Hill-climbs the connection count and then the requests in flight per
+    connection of one transfer, keeping each step only if it raised the
+    throughput. FLOOD_WAITs and timeouts halve both, at most once per
+    cool-down, after which the climb starts over. Settings that were not
+    given explicitly start from what the last transfer on the DC learned.
+    """
+
+    interval: float = 2.0
+    cooldown: float = 6.0
+    max_in_flight: int = 8
+    dc_id: int
+    max_connections: int
+    connections: int
+    in_flight: int
+
+    def __init__(
+        self,
+        dc_id: int,
+        max_connections: int,
+        connections: Optional[int] = None,
+        in_flight: Optional[int] = None,
+    ) -> None:
+        learned_connections, learned_in_flight = dc_tuning.get(dc_id, (None, 2))
+        self.dc_id = dc_id
+        self.max_connections = max_connections
+        self.tune_connections = connections is None
+        self.tune_in_flight = in_flight is None
+        self.connections = min(
+            max_connections, connections or learned_connections or max_connections
+        )
+        self.in_flight = in_flight or learned_in_flight
+        if self.tune_connections:
+            self._phase = "connections"
+        else:
+            self._phase = "in_flight" if self.tune_in_flight else None
+        self._last_rate = 0.0
+        self._last_step: Optional[Tuple[str, int]] = None
+        self._flooded = False
+        # Set by the first backoff, what such a transfer ends up with isn't remembered
+        self._backed_off = False
+        self._calm_at = 0.0
+        self._climb_again = False
+        self._reset()
+
+    def _reset(self) -> None:
+        self._bytes = 0
+        self._since = time.monotonic()
+
+    def record(self, nbytes: int) -> None:
+        self._bytes += nbytes
+
+    def backoff(self) -> None:
+        self._flooded = True
+
+    def step(self, limit: int) -> bool:
+        # Returns whether the settings changed, `limit` is the scheduler's current share
+        now = time.monotonic()
+        if self._flooded:
+            self._flooded = False
+            # Errors right after a backoff are usually from the same burst
+            if now >= self._calm_at:
+                self._backed_off = True
+                self._climb_again = True
+                self._calm_at = now + self.cooldown
+                self._phase = None
+                self._last_step = None
+                self._reset()
+                # A quarter off, rounded up, so a single FLOOD_WAIT costs little throughput
+                if self.tune_connections:
+                    self.connections = math.ceil(min(self.connections, limit) * 3 / 4)
+                if self.tune_in_flight:
+                    self.in_flight = math.ceil(self.in_flight * 3 / 4)
+                return True
+        if self._climb_again and now >= self._calm_at:
+            # Calm again, climb back up from the backed off settings
+            self._climb_again = False
+            self._phase = "connections" if self.tune_connections else (
+                "in_flight" if self.tune_in_flight else None
+            )
+            self._last_rate = 0.0
+            self._reset()
+            return False
+        elapsed = now - self._since
+        if not self._phase or elapsed < self.interval:
+            return False
+        rate = self._bytes / elapsed
+        self._reset()
+        if self._last_step and rate < self._last_rate * 1.05:
+            # The last step didn't pay off, undo it and move on to the next setting
+            name, delta = self._last_step
+            setattr(self, name, getattr(self, name) - delta)
+            self._last_step = None
+            self._next_phase()
+            return True
+        self._last_rate = rate
+        return self._grow(limit)
+
+    def _next_phase(self) -> None:
+        if self._phase == "connections" and self.tune_in_flight:
+            self._phase = "in_flight"
         else:
-            self.request = SaveFilePartRequest(file_id, index, b"")
-        self.stride = stride
-        self.previous = None
-        self.loop = loop
+            self._phase = None
+
+    def _grow(self, limit: int) -> bool:
+        if self._phase == "connections":
+            delta = min(2, min(self.max_connections, limit) - self.connections)
+            if delta <= 0:
+                self._next_phase()
+        if self._phase == "in_flight":
+            delta = min(1, self.max_in_flight - self.in_flight)
+            if delta <= 0:
+                self._next_phase()
+        if not self._phase:
+            self._last_step = None
+            return False
+        setattr(self, self._phase, getattr(self, self._phase) + delta)
+        self._last_step = (self._phase, delta)
+        return True
+
+    def remember(self) -> None:
+        if self._backed_off:
+            # Settings squeezed by FLOOD_WAITs or timeouts would hold back the next transfer
+            return
+        learned_connections, learned_in_flight = dc_tuning.get(self.dc_id, (None, 2))
+        if self.tune_connections:
+            learned_connections = (
+                self.connections if self.connections < self.max_connections else None
+            )
+        if self.tune_in_flight:
+            learned_in_flight = self.in_flight
+        dc_tuning[self.dc_id] = (learned_connections, learned_in_flight)
 
-    async def next(self, data: bytes) -> None:
-        if self.previous:
-            await self.previous
-        self.previous = self.loop.create_task(self._next(data))
 
-    async def _next(self, data: bytes) -> None:
-        self.request.bytes = data
-        await self.client._call(self.sender, self.request)
-        self.request.file_part += self.stride
+transfer_ids = itertools.count(1)
 
-    async def disconnect(self) -> None:
-        if self.previous:
-            await self.previous
-        return await self.sender.disconnect()
+# Whether downloads accept redirects to CDN DCs
+use_cdn = True
+
+
+def enable_cdn(enabled: bool = True) -> None:
+    global use_cdn
+    use_cdn = enabled
+
+# Errors after which a part is sent again on another connection
+RETRY_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError, TimedOutError, ServerError)
+MAX_PART_RETRIES = 5
 
 
 class ParallelTransferrer:
@@ -148,23 +1119,305 @@ class ParallelTransferrer:
     dc_id: int
     senders: Optional[List[Union[DownloadSender, UploadSender]]]
     auth_key: AuthKey
-    upload_ticker: int
+    pool: SenderPool
+    priority: int
+    ticket: Optional[TransferTicket]
+    tuner: Optional[TransferTuner]
+    upload_part: int
 
-    def __init__(self, client: TelegramClient, dc_id: Optional[int] = None) -> None:
+    def __init__(
+        self,
+        client: TelegramClient,
+        dc_id: Optional[int] = None,
+        priority: int = PRIORITY_NORMAL,
+    ) -> None:
         self.client = client
         self.loop = self.client.loop
+        self._set_dc(dc_id)
+        self.priority = priority
+        self.ticket = None
+        self.tuner = None
+        self.senders = None
+        self.upload_part = 0
+        self._workers: Set[asyncio.Task] = set()
+        self._retries: DefaultDict[int, int] = defaultdict(int)
+        self._paused_until = 0.0
+        # Told about every FLOOD_WAIT, with its length in seconds
+        self.on_flood: Optional[Callable[[float], None]] = None
+        self._cdn: Optional[CdnSession] = None
+        self._cdn_supported = use_cdn
+        # Bytes of the memory budget this transfer holds
+        self._held = 0
+        # Downloads check every part against the file's hashes if set
+        self.verify = False
+        self._part_hashes: Optional[PartHashes] = None
+        self.id = next(transfer_ids)
+        self._started = time.monotonic()
+
+    def _set_dc(self, dc_id: Optional[int]) -> None:
         self.dc_id = dc_id or self.client.session.dc_id
         self.auth_key = (
             None
             if dc_id and self.client.session.dc_id != dc_id
             else self.client.session.auth_key
         )
-        self.senders = None
-        self.upload_ticker = 0
+        self.pool = get_sender_pool(self.client, self.dc_id)
 
-    async def _cleanup(self) -> None:
-        await asyncio.gather(*[sender.disconnect() for sender in self.senders])
-        self.senders = None
+    async def _cleanup(self, healthy: bool = True) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = set()
+        senders, self.senders = self.senders or [], None
+        for sender in senders:
+            sender.broken = sender.broken or not healthy
+            self._release(sender)
+        if self.ticket:
+            self.ticket.release()
+            self.ticket = None
+            if metrics_hooks:
+                _emit(
+                    "transfer_seconds",
+                    time.monotonic() - self._started,
+                    **self._labels(),
+                    result="ok" if healthy else "failed",
+                )
+        if self.tuner and healthy:
+            self.tuner.remember()
+        # Also covers parts whose tasks were cancelled before they could hand their room back
+        self._unhold(self._held)
+
+    async def _hold(self, size: int, wait: bool = True) -> None:
+        if not wait:
+            memory_budget.force(size)
+        elif metrics_hooks and not memory_budget.fits(size):
+            started = time.monotonic()
+            await memory_budget.reserve(size)
+            _emit("memory_wait_seconds", time.monotonic() - started, **self._labels())
+        else:
+            await memory_budget.reserve(size)
+        self._held += size
+
+    def _unhold(self, size: int) -> None:
+        # Late releases after the cleanup gave everything back are no-ops
+        size = min(size, self._held)
+        if size:
+            self._held -= size
+            memory_budget.release(size)
+
+    def _release(self, sender: Union[DownloadSender, UploadSender]) -> None:
+        if not sender.released:
+            sender.released = True
+            sender.pool.release(sender.sender, not sender.broken)
+
+    def _retire(self, sender: Union[DownloadSender, UploadSender]) -> None:
+        # It finishes the parts it is on, the last one hands the connection back
+        sender.retired = True
+        if sender in self.senders:
+            self.senders.remove(sender)
+        if not sender.workers or sender.broken:
+            self._release(sender)
+
+    async def _admit(
+        self,
+        file_size: int,
+        connection_count: Optional[int],
+        in_flight: Optional[int],
+    ) -> int:
+        wanted = connection_count or self._get_connection_count(file_size)
+        self.tuner = TransferTuner(self.dc_id, wanted, connection_count, in_flight)
+        self._started = time.monotonic()
+        self.ticket = await transfer_scheduler.admit(
+            self.client, self.dc_id, wanted, file_size, self.priority
+        )
+        if metrics_hooks:
+            _emit("queue_seconds", time.monotonic() - self._started, **self._labels())
+        return self._target()
+
+    def _labels(self) -> Dict[str, str]:
+        return {
+            "dc": str(self.dc_id),
+            "direction": "upload" if self._upload else "download",
+            "transfer": str(self.id),
+        }
+
+    def _target(self) -> int:
+        return min(self.ticket.granted, self.tuner.connections)
+
+    def _measure(self, sender: Union[DownloadSender, UploadSender], nbytes: int, started: float) -> None:
+        rtt = time.monotonic() - started
+        sender.rtt = rtt if not sender.rtt else 0.8 * sender.rtt + 0.2 * rtt
+        self.tuner.record(nbytes)
+        if metrics_hooks:
+            labels = self._labels()
+            _emit("part_bytes", nbytes, **labels)
+            _emit("part_seconds", rtt, **labels, sender=str(id(sender.sender)))
+
+    def _failed(self, e: Exception) -> None:
+        self._error = self._error or e
+        # Wakes up whoever is waiting for parts or free senders
+        self._arrived.set()
+        if self._upload:
+            self._free.put_nowait(None)
+
+    def _should_retry(
+        self, sender: Union[DownloadSender, UploadSender], index: int, e: Exception
+    ) -> bool:
+        self._retries[index] += 1
+        if metrics_hooks:
+            _emit("part_retries", 1, **self._labels(), reason=type(e).__name__)
+        if self._retries[index] > MAX_PART_RETRIES:
+            self._failed(e)
+            return False
+        if isinstance(e, FloodError):
+            # Flood limits hold for the whole account, so every sender of this transfer waits
+            seconds = getattr(e, "seconds", 0) or 1
+            log.info(f"FLOOD_WAIT of {seconds}s on DC {self.dc_id}, pausing the transfer")
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            if metrics_hooks:
+                _emit("flood_wait_seconds", seconds, **self._labels())
+            self.tuner.backoff()
+            if self.on_flood:
+                self.on_flood(seconds)
+            return True
+        if isinstance(e, CdnRedirect):
+            self._follow_cdn(e.redirect)
+            return True
+        if getattr(sender, "cdn", None) and isinstance(e, (RPCError, SecurityError)):
+            # Bad tokens, hashes that do not match and the like, the origin DC still has the file
+            self._leave_cdn(e)
+            return True
+        if isinstance(e, FileMigrateError) and not self._upload:
+            self._migrate(e.new_dc)
+            return True
+        if (
+            isinstance(e, (UnauthorizedError, AuthKeyNotFound))
+            and not self.auth_key
+            and not getattr(sender, "cdn", None)
+        ):
+            # An imported authorization was revoked, a fresh one is exported for the replacement
+            log.info(f"Authorization for DC {self.dc_id} is no longer valid: {e!r}")
+            auth_key = sender.sender.auth_key
+            get_auth_cache(self.client).forget(self.dc_id, auth_key)
+            self.pool.drop(auth_key)
+            if not sender.retired:
+                sender.broken = True
+                self._retire(sender)
+                self._spawn(self._replace())
+            return True
+        if isinstance(e, PartHashMismatch):
+            # The part is fetched again right away, by whichever sender is free first
+            log.warning(f"Part {index} from DC {self.dc_id} failed its hash check, fetching it again")
+            return True
+        if isinstance(e, RETRY_ERRORS):
+            log.info(f"Replacing sender for DC {self.dc_id} after {e!r}")
+            if isinstance(e, (TimedOutError, asyncio.TimeoutError)):
+                self.tuner.backoff()
+            if not sender.retired:
+                sender.broken = True
+                self._retire(sender)
+                self._spawn(self._replace())
+            return True
+        self._failed(e)
+        return False
+
+    def _migrate(self, dc_id: int) -> None:
+        if dc_id == self.dc_id:
+            return
+        log.info(f"File lives in DC {dc_id}, moving the transfer there from DC {self.dc_id}")
+        for sender in list(self.senders):
+            self._retire(sender)
+        self._set_dc(dc_id)
+        self._spawn(self._replace())
+
+    def _follow_cdn(self, redirect: FileCdnRedirect) -> None:
+        if self._cdn:
+            return
+        log.info(f"File redirected from DC {self.dc_id} to CDN DC {redirect.dc_id}")
+        self._cdn = CdnSession(self.client, self.dc_id, redirect)
+        for sender in list(self.senders):
+            self._retire(sender)
+        # CDN senders connect without an authorization, there is no key to reuse
+        self.dc_id = redirect.dc_id
+        self.auth_key = None
+        self.pool = get_sender_pool(self.client, redirect.dc_id)
+        self._spawn(self._replace())
+
+    def _leave_cdn(self, e: Exception) -> None:
+        if not self._cdn:
+            return
+        log.warning(f"CDN DC {self.dc_id} failed with {e!r}, downloading from the origin DC")
+        origin_dc, self._cdn = self._cdn.origin_dc, None
+        self._cdn_supported = False
+        for sender in list(self.senders):
+            self._retire(sender)
+        self._set_dc(origin_dc)
+        self._spawn(self._replace())
+
+    async def _replace(self) -> None:
+        try:
+            sender = await self.pool.acquire(self._create_sender)
+        except Exception as e:
+            if self.senders is None:
+                return
+            # Only fatal once no sender is left, otherwise those pick up the remaining parts
+            if not self.senders:
+                self._failed(e)
+                return
+            log.info(f"Could not replace a sender for DC {self.dc_id}: {e!r}")
+            for sender in self.senders:
+                self._fill_slots(sender)
+            return
+        if self.senders is None:
+            self.pool.release(sender)
+            return
+        self._start([sender])
+
+    async def _wait_pause(self) -> None:
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _retune(self) -> None:
+        if self.tuner.step(self.ticket.granted):
+            for sender in self.senders:
+                self._fill_slots(sender)
+        if self.senders and len(self.senders) != self._target():
+            self._start(await self._resize_senders())
+
+    async def _resize_senders(self) -> List[MTProtoSender]:
+        connections = self._target()
+        for sender in self.senders[connections:]:
+            self._retire(sender)
+        return await self._acquire_more(connections - len(self.senders))
+
+    async def _acquire_more(self, count: int) -> List[MTProtoSender]:
+        # Extra connections are a bonus, one that fails to connect is simply left out
+        more = await asyncio.gather(
+            *[
+                self.pool.acquire(self._create_sender, wait=False)
+                for _ in range(count)
+            ],
+            return_exceptions=True,
+        )
+        senders = []
+        for sender in more:
+            if isinstance(sender, BaseException):
+                log.info(f"Could not add a sender for DC {self.dc_id}: {sender!r}")
+            elif sender:
+                senders.append(sender)
+        return senders
+
+    def _spawn(self, coro: Awaitable[None]) -> None:
+        task = self.loop.create_task(coro)
+        self._workers.add(task)
+        task.add_done_callback(self._workers.discard)
+
+    async def _acquire_senders(self, connections: int) -> List[MTProtoSender]:
+        # The first cross-DC sender may have to export+import the authorization, so we always get
+        # it before asking for any other senders. Only the first one waits for a free pool slot,
+        # the rest are taken opportunistically so concurrent transfers can't deadlock the pool.
+        first = await self.pool.acquire(self._create_sender)
+        return [first, *await self._acquire_more(connections - 1)]
 
     @staticmethod
     def _get_connection_count(
@@ -174,82 +1427,152 @@ class ParallelTransferrer:
             return max_count
         return math.ceil((file_size / full_size) * max_count)
 
-    async def _init_download(
-        self, connections: int, file: TypeLocation, part_count: int, part_size: int
-    ) -> None:
-        minimum, remainder = divmod(part_count, connections)
-
-        def get_part_count() -> int:
-            nonlocal remainder
-            if remainder > 0:
-                remainder -= 1
-                return minimum + 1
-            return minimum
-
-        # The first cross-DC sender will export+import the authorization, so we always create it
-        # before creating any other senders.
-        self.senders = [
-            await self._create_download_sender(
-                file, 0, part_size, connections * part_size, get_part_count()
-            ),
-            *await asyncio.gather(
-                *[
-                    self._create_download_sender(
-                        file, i, part_size, connections * part_size, get_part_count()
-                    )
-                    for i in range(1, connections)
-                ]
-            ),
-        ]
+    def _start(self, senders: List[MTProtoSender]) -> None:
+        for sender in senders:
+            if self._upload:
+                sender = UploadSender(self.client, sender, self.pool, *self._upload)
+            else:
+                sender = DownloadSender(
+                    self.client,
+                    sender,
+                    self.pool,
+                    self._file,
+                    self._part_size,
+                    self._cdn,
+                    self._cdn_supported,
+                    self._part_hashes,
+                )
+            self.senders.append(sender)
+            self._fill_slots(sender)
 
-    async def _create_download_sender(
-        self,
-        file: TypeLocation,
-        index: int,
-        part_size: int,
-        stride: int,
-        part_count: int,
-    ) -> DownloadSender:
-        return DownloadSender(
-            self.client,
-            await self._create_sender(),
-            file,
-            index * part_size,
-            part_size,
-            stride,
-            part_count,
-        )
+    def _fill_slots(self, sender: Union[DownloadSender, UploadSender]) -> None:
+        # Only ever adds, senders above the tuner's depth shed their extra slots as they go
+        if isinstance(sender, UploadSender):
+            while sender.slots < self.tuner.in_flight:
+                sender.slots += 1
+                self._free.put_nowait(sender)
+            return
+        while sender.workers < self.tuner.in_flight:
+            sender.workers += 1
+            self._spawn(self._download_worker(sender))
 
-    async def _init_upload(
-        self, connections: int, file_id: int, part_count: int, big: bool
-    ) -> None:
-        self.senders = [
-            await self._create_upload_sender(file_id, part_count, big, 0, connections),
-            *await asyncio.gather(
-                *[
-                    self._create_upload_sender(file_id, part_count, big, i, connections)
-                    for i in range(1, connections)
-                ]
-            ),
-        ]
+    async def _download_worker(self, sender: DownloadSender) -> None:
+        # Every worker brings room for two parts in the reorder buffer, one in flight and
+        # one waiting to be read. The room comes out of the memory budget, only the first
+        # worker of a transfer never waits for it so every transfer keeps moving.
+        room = 2 * self._part_size
+        held = False
+        try:
+            await self._hold(room, wait=bool(self._room))
+            held = True
+            self._room += 2
+            while not sender.retired and sender.workers <= self.tuner.in_flight:
+                await self._wait_pause()
+                # Parts are taken in offset order, so the one the reader waits for is always
+                # in flight or buffered and room frees up as soon as it is read. A retried
+                # part can fall behind the buffer, that one may always go.
+                while self._taken >= self._room and not self._wanted_next():
+                    self._freed.clear()
+                    await self._freed.wait()
+                if sender.retired or not self._parts:
+                    return
+                index = self._parts.popleft()
+                self._taken += 1
+                started = time.monotonic()
+                try:
+                    data = await sender.next(index)
+                except Exception as e:
+                    # Failed parts go back in order, any healthy sender may pick them up
+                    self._taken -= 1
+                    bisect.insort(self._parts, index)
+                    self._freed.set()
+                    if not self._should_retry(sender, index, e):
+                        return
+                    # Workers of the other senders may have run out of parts and left,
+                    # without them nobody would pick this one up again
+                    for other in self.senders or ():
+                        self._fill_slots(other)
+                    continue
+                finally:
+                    self._arrived.set()
+                self._received[index] = data
+                self._measure(sender, len(data), started)
+        finally:
+            if held:
+                self._room -= 2
+                self._unhold(room)
+            # A reader sharing its queue checks whether anything is left in flight
+            self._arrived.set()
+            sender.workers -= 1
+            if sender.retired and not sender.workers:
+                self._release(sender)
+
+    def _wanted_next(self) -> bool:
+        return bool(self._parts) and self._parts[0] == self._wanted
+
+    async def _next_free(self) -> UploadSender:
+        while True:
+            if self._error:
+                raise self._error
+            sender = await self._free.get()
+            if sender is None:
+                # Passes the wake-up on to the next one waiting
+                self._free.put_nowait(None)
+            elif not sender.retired:
+                sender.workers += 1
+                return sender
+
+    async def _upload_part(self, sender: UploadSender, index: int, data: bytes) -> None:
+        try:
+            while True:
+                retry = False
+                try:
+                    await self._wait_pause()
+                    started = time.monotonic()
+                    await sender.next(index, data)
+                    self._measure(sender, len(data), started)
+                except Exception as e:
+                    retry = self._should_retry(sender, index, e)
+                finally:
+                    sender.workers -= 1
+                    if sender.retired:
+                        if not sender.workers:
+                            self._release(sender)
+                    elif sender.slots > self.tuner.in_flight:
+                        sender.slots -= 1
+                    else:
+                        self._free.put_nowait(sender)
+                if not retry:
+                    return
+                sender = await self._next_free()
+        finally:
+            self._unhold(len(data))
 
-    async def _create_upload_sender(
-        self, file_id: int, part_count: int, big: bool, index: int, stride: int
-    ) -> UploadSender:
-        return UploadSender(
-            self.client,
-            await self._create_sender(),
-            file_id,
-            part_count,
-            big,
-            index,
-            stride,
-            loop=self.loop,
+    async def _fetch_hashes(self, sender: MTProtoSender, offset: int) -> list:
+        return await self.client._call(
+            sender, GetFileHashesRequest(self._file, offset), flood_sleep_threshold=0
         )
 
+    @property
+    def verified(self) -> bool:
+        # Only true once a download with `verify` could check every part it fetched
+        return bool(self._part_hashes) and not self._part_hashes.unverified
+
     async def _create_sender(self) -> MTProtoSender:
-        dc = await self.client._get_dc(self.dc_id)
-        sender = MTProtoSender(self.auth_key, loggers=self.client._log)
+        if self._cdn:
+            return await self._connect_sender(None, cdn=True)
+        if self.auth_key:
+            return await self._connect_sender(self.auth_key)
+        return await get_auth_cache(self.client).create_sender(
+            self.dc_id, self._connect_sender
+        )
+
+    async def _connect_sender(
+        self, auth_key: Optional[AuthKey], cdn: bool = False
+    ) -> MTProtoSender:
+        started = time.monotonic()
+        dc = await self.client._get_dc(self.dc_id, cdn=cdn)
+        sender = MTProtoSender(auth_key, loggers=self.client._log)
         await sender.connect(
             self.client._connection(
                 dc.ip_address,
@@ -259,14 +1582,8 @@ class ParallelTransferrer:
                 proxy=self.client._proxy,
             )
         )
-        if not self.auth_key:
-            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
-            self.client._init_request.query = ImportAuthorizationRequest(
-                id=auth.id, bytes=auth.bytes
-            )
-            req = InvokeWithLayerRequest(LAYER, self.client._init_request)
-            await sender.send(req)
-            self.auth_key = sender.auth_key
+        if metrics_hooks:
+            _emit("connect_seconds", time.monotonic() - started, dc=str(self.dc_id))
         return sender
 
     async def init_upload(
@@ -275,19 +1592,48 @@ class ParallelTransferrer:
         file_size: int,
         part_size_kb: Optional[float] = None,
         connection_count: Optional[int] = None,
+        in_flight: Optional[int] = None,
     ) -> Tuple[int, int, bool]:
-        connection_count = connection_count or self._get_connection_count(file_size)
         part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
         part_count = (file_size + part_size - 1) // part_size
         is_large = file_size > 10 * 1024 * 1024
-        await self._init_upload(connection_count, file_id, part_count, is_large)
+
+        self._upload = (file_id, part_count, is_large)
+        # Every sender is in here once per part it may still take on
+        self._free: asyncio.Queue = asyncio.Queue()
+        self._arrived = asyncio.Event()
+        self._error: Optional[Exception] = None
+        self.senders = []
+
+        connection_count = await self._admit(file_size, connection_count, in_flight)
+        try:
+            self._start(await self._acquire_senders(connection_count))
+        except BaseException:
+            await self._cleanup(healthy=False)
+            raise
         return part_size, part_count, is_large
 
     async def upload(self, part: bytes) -> None:
-        await self.senders[self.upload_ticker].next(part)
-        self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
+        await self._retune()
+        # Parts already in flight finish without more room, so only those after the
+        # first may wait for the memory budget
+        await self._hold(len(part), wait=bool(self._held))
+        # Parts go to whichever connection has a free slot first, so one slow sender
+        # doesn't hold up the rest
+        sender = await self._next_free()
+        self._spawn(self._upload_part(sender, self.upload_part, part))
+        self.upload_part += 1
 
     async def finish_upload(self) -> None:
+        try:
+            # Retried parts may still be waiting for a replacement sender
+            while self._workers:
+                await asyncio.wait(set(self._workers))
+            if self._error:
+                raise self._error
+        except BaseException:
+            await self._cleanup(healthy=False)
+            raise
         await self._cleanup()
 
     async def download(
@@ -296,29 +1642,437 @@ class ParallelTransferrer:
         file_size: int,
         part_size_kb: Optional[float] = None,
         connection_count: Optional[int] = None,
+        in_flight: Optional[int] = None,
     ) -> AsyncGenerator[bytes, None]:
-        connection_count = connection_count or self._get_connection_count(file_size)
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
-        part_count = math.ceil(file_size / part_size)
-        await self._init_download(connection_count, file, part_count, part_size)
-
-        part = 0
-        while part < part_count:
-            tasks = []
-            for sender in self.senders:
-                tasks.append(self.loop.create_task(sender.next()))
-            for task in tasks:
-                data = await task
-                if not data:
-                    break
+        parts = self.download_parts(
+            file, file_size, part_size_kb, connection_count, in_flight
+        )
+        try:
+            async for _, data in parts:
                 yield data
-                part += 1
-        await self._cleanup()
-
+        finally:
+            await parts.aclose()
 
-parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(
-    lambda: asyncio.Lock()
-)
+    async def download_parts(
+        self,
+        file: TypeLocation,
+        file_size: int,
+        part_size_kb: Optional[float] = None,
+        connection_count: Optional[int] = None,
+        in_flight: Optional[int] = None,
+        parts: Optional[Iterable[int]] = None,
+        ordered: bool = True,
+        queue: Optional[Deque[int]] = None,
+    ) -> AsyncGenerator[Tuple[int, bytes], None]:
+        part_size = int((part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024)
+        part_count = math.ceil(file_size / part_size)
+        if queue is not None:
+            # Shared with other transfers of the same file, parts arrive in any order until
+            # the queue runs dry. Failed parts go back into it for anyone to pick up.
+            parts, ordered = queue, False
+            remaining_size = file_size
+        else:
+            parts = sorted(parts) if parts is not None else list(range(part_count))
+            if not parts:
+                return
+            remaining_size = min(len(parts) * part_size, file_size)
+
+        self._upload = None
+        self._file = file
+        self._part_size = part_size
+        self._part_hashes = PartHashes(self._fetch_hashes) if self.verify else None
+        self._parts = queue if queue is not None else deque(parts)
+        self._received: Dict[int, bytes] = {}
+        self._arrived = asyncio.Event()
+        self._error: Optional[Exception] = None
+        # Parts in flight plus parts waiting to be read, bounded by the room workers bring
+        self._taken = 0
+        self._room = 0
+        self._freed = asyncio.Event()
+        self._wanted: Optional[int] = None
+        self.senders = []
+
+        connection_count = await self._admit(remaining_size, connection_count, in_flight)
+        healthy = False
+        try:
+            self._start(await self._acquire_senders(connection_count))
+            for part in parts if queue is None else itertools.count():
+                await self._retune()
+                if ordered:
+                    self._wanted = part
+                    self._freed.set()
+                while (part not in self._received) if ordered else not self._received:
+                    if self._error:
+                        raise self._error
+                    if queue is not None and not self._taken:
+                        if not queue:
+                            break
+                        # Parts given back by others after our workers ran out of them
+                        for sender in self.senders:
+                            self._fill_slots(sender)
+                    self._arrived.clear()
+                    await self._arrived.wait()
+                if not self._received and not ordered:
+                    # Only a shared queue gets here, once it is empty and nothing is in flight
+                    break
+                if not ordered:
+                    # Whichever part arrived first, the loop only counts them
+                    part = next(iter(self._received))
+                data = self._received.pop(part)
+                self._taken -= 1
+                self._freed.set()
+                if not data:
+                    if ordered:
+                        break
+                    continue
+                yield part, data
+            healthy = True
+        finally:
+            await self._cleanup(healthy)
+
+
+class DownloadManifest:
+    """
+    Sidecar file that records which parts of a download already made it to
+    disk, so an interrupted download only fetches the missing ones.
+    """
+
+    path: str
+    file_id: Optional[int]
+    access_hash: Optional[int]
+    size: int
+    part_size: int
+    parts: Set[int]
+
+    def __init__(
+        self,
+        path: str,
+        file_id: Optional[int],
+        access_hash: Optional[int],
+        size: int,
+        part_size: int,
+        parts: Iterable[int] = (),
+    ) -> None:
+        self.path = path
+        self.file_id = file_id
+        self.access_hash = access_hash
+        self.size = size
+        self.part_size = part_size
+        self.parts = set(parts)
+        self._saved_at = 0.0
+
+    @classmethod
+    def open(cls, file_path: str, location: TypeLocation, size: int) -> "DownloadManifest":
+        path = f"{file_path}.part.json"
+        file_id = getattr(location, "id", None)
+        access_hash = getattr(location, "access_hash", None)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if (data["id"], data["access_hash"], data["size"]) == (file_id, access_hash, size):
+                return cls(
+                    path, file_id, access_hash, size, data["part_size"], data["parts"]
+                )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f"Ignoring unreadable download manifest {path}: {e!r}")
+        part_size = utils.get_appropriated_part_size(size) * 1024
+        return cls(path, file_id, access_hash, size, part_size)
+
+    @property
+    def part_count(self) -> int:
+        return math.ceil(self.size / self.part_size)
+
+    @property
+    def done_bytes(self) -> int:
+        last = self.part_count - 1
+        return sum(
+            self.size - last * self.part_size if part == last else self.part_size
+            for part in self.parts
+        )
+
+    def missing(self) -> List[int]:
+        return [part for part in range(self.part_count) if part not in self.parts]
+
+    def trim(self, length: int) -> None:
+        # Parts past the end of the partial file never made it to disk, whatever the manifest says
+        kept = {
+            part
+            for part in self.parts
+            if min((part + 1) * self.part_size, self.size) <= length
+        }
+        if kept != self.parts:
+            log.warning(
+                f"{len(self.parts) - len(kept)} parts listed in {self.path} are missing "
+                f"from the partial file, fetching them again"
+            )
+            self.parts = kept
+
+    async def save(self, force: bool = True) -> None:
+        # Rewritten at most once a second while parts are streaming in
+        if not force and time.monotonic() - self._saved_at < 1:
+            return
+        self._saved_at = time.monotonic()
+        data = {
+            "id": self.file_id,
+            "access_hash": self.access_hash,
+            "size": self.size,
+            "part_size": self.part_size,
+            "parts": sorted(self.parts),
+        }
+        await run_io(self._write, data)
+
+    def _write(self, data: Dict) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FileSink:
+    """
+    Download target that preallocates the whole file next to its final path,
+    writes every part at its own offset as soon as it arrives and is renamed
+    into place once the download is complete.
+    """
+
+    name: str
+    tmp_path: str
+    size: int
+    existing: int
+    verified: Optional[bool]
+
+    def __init__(self, path: str, size: int, resume: bool = False) -> None:
+        self.name = path
+        self.tmp_path = f"{path}.part"
+        self.size = size
+        # Set by downloads asked to verify their parts
+        self.verified = None
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if not resume:
+            flags |= os.O_TRUNC
+        self._fd = os.open(self.tmp_path, flags, 0o644)
+        try:
+            # What an earlier attempt left behind, before preallocation pads it with zeros
+            self.existing = os.fstat(self._fd).st_size
+            self._preallocate()
+        except BaseException:
+            self.close()
+            raise
+
+    def _preallocate(self) -> None:
+        if self.size <= 0:
+            return
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self._fd, 0, self.size)
+                return
+            except OSError:
+                # Not every filesystem supports it, the file is still sized below
+                pass
+        if os.fstat(self._fd).st_size < self.size:
+            os.ftruncate(self._fd, self.size)
+
+    def write_at(self, offset: int, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self._fd, view, offset)
+            else:
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                written = os.write(self._fd, view)
+            view = view[written:]
+            offset += written
+
+    def flush(self) -> None:
+        # Positional writes go straight to the OS, there is nothing buffered here
+        pass
+
+    def truncate(self, size: int) -> None:
+        os.ftruncate(self._fd, size)
+
+    def commit(self) -> str:
+        self.close()
+        os.replace(self.tmp_path, self.name)
+        return self.name
+
+    def close(self, keep: bool = True) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if not keep:
+            try:
+                os.remove(self.tmp_path)
+            except FileNotFoundError:
+                pass
+
+
+def _write_at(out: Union[BinaryIO, FileSink], offset: int, data: bytes) -> None:
+    if isinstance(out, FileSink):
+        out.write_at(offset, data)
+    else:
+        out.seek(offset)
+        out.write(data)
+
+
+def run_io(func: Callable, *args) -> Awaitable:
+    return asyncio.get_event_loop().run_in_executor(io_executor, func, *args)
+
+
+class WriteBehind:
+    """
+    Queues writes for the I/O threads and lets the download carry on. Writes
+    run one after the other in the order they were queued, at most `depth`
+    of them may be pending before `put` waits.
+    """
+
+    def __init__(self, write: Callable[..., None], depth: int = 8) -> None:
+        self._write = write
+        self._slots = asyncio.Semaphore(depth)
+        self._last: Optional[asyncio.Future] = None
+        self._error: Optional[Exception] = None
+
+    async def put(self, *args, done: Optional[Callable[[], None]] = None) -> None:
+        if self._error:
+            raise self._error
+        if metrics_hooks and self._slots.locked():
+            started = time.monotonic()
+            await self._slots.acquire()
+            _emit("disk_wait_seconds", time.monotonic() - started, op="write")
+        else:
+            await self._slots.acquire()
+        self._last = asyncio.ensure_future(self._run(self._last, args, done))
+
+    async def _run(
+        self,
+        previous: Optional[asyncio.Future],
+        args: tuple,
+        done: Optional[Callable[[], None]],
+    ) -> None:
+        try:
+            if previous:
+                await previous
+            if not self._error:
+                await run_io(self._write, *args)
+                if done:
+                    done()
+        except Exception as e:
+            self._error = self._error or e
+        finally:
+            self._slots.release()
+
+    async def drain(self) -> None:
+        if self._last:
+            await self._last
+        if self._error:
+            raise self._error
+
+    async def close(self) -> None:
+        # The file must not be closed under pending writes, errors are left to `drain`
+        if self._last:
+            await asyncio.wait([self._last])
+
+
+class ReadAhead:
+    """
+    Reads up to `depth` chunks ahead on the I/O threads, so the next chunk is
+    usually ready by the time the upload asks for it.
+    """
+
+    def __init__(self, read: Callable[[], bytes], depth: int = 4) -> None:
+        self._read = read
+        self._queue: asyncio.Queue = asyncio.Queue(depth)
+        self._pending: Optional[asyncio.Future] = None
+        self._task = asyncio.ensure_future(self._fill())
+
+    async def _fill(self) -> None:
+        try:
+            while True:
+                self._pending = run_io(self._read)
+                data = await asyncio.shield(self._pending)
+                await self._queue.put(data)
+                if not data:
+                    return
+        except Exception as e:
+            await self._queue.put(e)
+
+    def __aiter__(self) -> "ReadAhead":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if metrics_hooks and self._queue.empty():
+            started = time.monotonic()
+            data = await self._queue.get()
+            _emit("disk_wait_seconds", time.monotonic() - started, op="read")
+        else:
+            data = await self._queue.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+    async def close(self) -> None:
+        self._task.cancel()
+        # A read that already started is left to finish, the file is usually closed next
+        if self._pending:
+            await asyncio.wait([self._pending])
+
+
+class PartReader:
+    """
+    Reads a file one upload part at a time. Regular files are read with
+    positional reads straight into the part's `bytes` object, skipping the
+    file object's own buffer; anything else falls back to `read`.
+    """
+
+    file: BinaryIO
+    part_size: int
+
+    def __init__(self, file: BinaryIO, part_size: int, hash_md5=None) -> None:
+        self.file = file
+        self.part_size = part_size
+        self._hash_md5 = hash_md5
+        try:
+            self._fd = file.fileno() if hasattr(os, "pread") else None
+            self._offset = file.tell()
+        except (AttributeError, OSError, ValueError):
+            self._fd = None
+
+    def _read(self, size: int) -> bytes:
+        if self._fd is None:
+            return self.file.read(size)
+        data = os.pread(self._fd, size, self._offset)
+        self._offset += len(data)
+        return data
+
+    def read(self) -> bytes:
+        data = self._read(self.part_size)
+        # Short reads only happen at the end of regular files, but pipes may return less
+        while data and len(data) < self.part_size:
+            more = self._read(self.part_size - len(data))
+            if not more:
+                break
+            data += more
+        if self._hash_md5:
+            self._hash_md5.update(data)
+        return data
+
+
+async def _report_progress(progress_callback: callable, current: int, total: int) -> None:
+    r = progress_callback(current, total)
+    if inspect.isawaitable(r):
+        try:
+            await r
+        except BaseException:
+            pass
 
 
 def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
@@ -330,7 +2084,11 @@ def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
 
 
 async def _internal_transfer_to_telegram(
-    client: TelegramClient, response: BinaryIO, progress_callback: callable, filename: str = None
+    client: TelegramClient,
+    response: BinaryIO,
+    progress_callback: callable,
+    filename: str = None,
+    priority: int = PRIORITY_NORMAL,
 ) -> Tuple[TypeInputFile, int]:
     file_id = helpers.generate_random_long()
     file_size = os.path.getsize(response.name)
@@ -340,33 +2098,25 @@ async def _internal_transfer_to_telegram(
         filename = os.path.basename(response.name)
 
     hash_md5 = hashlib.md5()
-    uploader = ParallelTransferrer(client)
+    uploader = ParallelTransferrer(client, priority=priority)
     part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
-    buffer = bytearray()
-    for data in stream_file(response):
-        if progress_callback:
-            r = progress_callback(response.tell(), file_size)
-            if inspect.isawaitable(r):
-                try:
-                    await r
-                except BaseException:
-                    pass
-        if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0 and len(data) == part_size:
+
+    # Telethon only serializes `bytes`, so each part is read into a fresh one, once
+    reader = ReadAhead(
+        PartReader(response, part_size, None if is_large else hash_md5).read
+    )
+    uploaded = 0
+    try:
+        async for data in reader:
             await uploader.upload(data)
-            continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
-            await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
+            uploaded += len(data)
+            if progress_callback:
+                await _report_progress(progress_callback, uploaded, file_size)
+    except BaseException:
+        await uploader._cleanup(healthy=False)
+        raise
+    finally:
+        await reader.close()
     await uploader.finish_upload()
     if is_large:
         return InputFileBig(file_id, part_count, filename), file_size
@@ -374,28 +2124,554 @@ async def _internal_transfer_to_telegram(
         return InputFile(file_id, part_count, filename, hash_md5.hexdigest()), file_size
 
 
+async def relay_file(
+    client: TelegramClient,
+    location: TypeLocation,
+    name: Optional[str] = None,
+    progress_callback: callable = None,
+    priority: int = PRIORITY_NORMAL,
+    upload_client: Optional[TelegramClient] = None,
+) -> TypeInputFile:
+    file_size = location.size
+    if name is None:
+        name = next(
+            (
+                attr.file_name
+                for attr in getattr(location, "attributes", ())
+                if getattr(attr, "file_name", None)
+            ),
+            f"file_{location.id}",
+        )
+    dc_id, location = utils.get_input_location(location)
+    file_id = helpers.generate_random_long()
+    hash_md5 = hashlib.md5()
+    downloader = ParallelTransferrer(client, dc_id, priority)
+    uploader = ParallelTransferrer(upload_client or client, priority=priority)
+    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
+
+    # Both sides use the same part size, so every downloaded part is sent as it is. The
+    # upload only takes a part once a sender has room for it, and the download stops
+    # fetching once its reorder buffer is full, which bounds what is held in memory.
+    downloaded = downloader.download(location, file_size, part_size_kb=part_size / 1024)
+    uploaded = 0
+    try:
+        async for data in downloaded:
+            if not is_large:
+                hash_md5.update(data)
+            await uploader.upload(data)
+            uploaded += len(data)
+            if progress_callback:
+                await _report_progress(progress_callback, uploaded, file_size)
+    except BaseException:
+        await uploader._cleanup(healthy=False)
+        raise
+    finally:
+        await downloaded.aclose()
+    await uploader.finish_upload()
+    if is_large:
+        return InputFileBig(file_id, part_count, name)
+    else:
+        return InputFile(file_id, part_count, name, hash_md5.hexdigest())
+
+
+# Files up to this size are fetched over an existing connection with a few pipelined requests
+SMALL_FILE_SIZE = 2 * 1024 * 1024
+SMALL_PART_SIZE = 1024 * 1024
+
+
+async def _small_parts(
+    client: TelegramClient,
+    dc_id: Optional[int],
+    location: TypeLocation,
+    size: Optional[int],
+    hashes: Optional["PartHashes"] = None,
+) -> AsyncGenerator[bytes, None]:
+    # Parts come out in order, so nothing but the part being written is kept around
+    index = 0
+    while True:
+        pool = None
+        if not dc_id or dc_id == client.session.dc_id:
+            sender = client._sender
+        else:
+            # Foreign DCs use a pooled sender, so the authorization is only imported once
+            transferrer = ParallelTransferrer(client, dc_id)
+            pool = transferrer.pool
+            sender = await pool.acquire(transferrer._create_sender)
+
+        async def get(index: int) -> bytes:
+            request = GetFileRequest(
+                location, offset=index * SMALL_PART_SIZE, limit=SMALL_PART_SIZE
+            )
+            for attempt in itertools.count(1):
+                data = (await client._call(sender, request)).bytes
+                if not hashes:
+                    return data
+                try:
+                    await hashes.verify(None, request.offset, SMALL_PART_SIZE, data)
+                    return data
+                except PartHashMismatch as e:
+                    if attempt > MAX_PART_RETRIES:
+                        raise
+                    log.warning(f"{e}, fetching it again")
+
+        healthy = True
+        try:
+            while True:
+                if size is not None:
+                    # Known sizes are at most SMALL_FILE_SIZE, all requests go out at once
+                    batch = range(index, math.ceil(size / SMALL_PART_SIZE))
+                else:
+                    # Without a size, parts are asked for until one comes back short
+                    batch = range(index, index + 1)
+                healthy = False
+                parts = await asyncio.gather(*[get(i) for i in batch])
+                healthy = True
+                for data in parts:
+                    index += 1
+                    if data:
+                        yield data
+                if size is not None or len(parts[-1]) < SMALL_PART_SIZE:
+                    return
+        except FileMigrateError as e:
+            healthy = True
+            dc_id = e.new_dc
+        except RPCError:
+            healthy = True
+            raise
+        finally:
+            if pool:
+                pool.release(sender, healthy)
+
+
+async def download_small(
+    client: TelegramClient,
+    location: TypeLocation,
+    out: Optional[Union[BinaryIO, bytearray]] = None,
+) -> Union[bytes, BinaryIO, bytearray]:
+    info = utils._get_file_info(location)
+    if info.size is not None and info.size > SMALL_FILE_SIZE:
+        # Too big for a few requests on one connection, it goes through the parallel downloader
+        downloaded = ParallelTransferrer(client, info.dc_id).download(
+            info.location, info.size
+        )
+    else:
+        downloaded = _small_parts(client, info.dc_id, info.location, info.size)
+    buffer = bytearray() if out is None else out
+    write = buffer.extend if isinstance(buffer, bytearray) else buffer.write
+    try:
+        async for data in downloaded:
+            write(data)
+    finally:
+        await downloaded.aclose()
+    return bytes(buffer) if out is None else out
+
+
 async def download_file(
     client: TelegramClient,
     location: TypeLocation,
-    out: BinaryIO,
+    out: Union[BinaryIO, FileSink],
+    progress_callback: callable = None,
+    priority: int = PRIORITY_NORMAL,
+    resume: bool = False,
+    verify: bool = False,
+) -> Union[BinaryIO, FileSink]:
+    # With `verify`, every part is checked against the hashes Telegram keeps for the file
+    # and fetched again if it doesn't match. `out.verified` tells whether all of them could
+    # be checked.
+    if isinstance(client, ClientPool):
+        return await client.download(location, out, progress_callback, priority, verify)
+    info = utils._get_file_info(location)
+    size = info.size
+    # Without a size there are no parts to resume, such files are small anyway
+    if size is None or (not resume and size <= SMALL_FILE_SIZE):
+        return await _small_download(client, info, out, progress_callback, verify)
+    if (
+        process_pool
+        and not resume
+        and not verify
+        and isinstance(out, FileSink)
+        and size >= PROCESS_TRANSFER_SIZE
+    ):
+        return await process_pool.download(
+            client, location, out, progress_callback, priority
+        )
+    manifest = None
+    if resume:
+        # Only a FileSink keeps what earlier attempts wrote and knows how much of it there is
+        if not isinstance(out, FileSink):
+            raise ValueError("resume needs a FileSink to write to")
+        manifest = await run_io(DownloadManifest.open, out.name, location, size)
+        manifest.trim(out.existing)
+    dc_id, location = info.dc_id, info.location
+    # Connections are budgeted by transfer_scheduler because telegram has connection count limits
+    downloader = ParallelTransferrer(client, dc_id, priority)
+    downloader.verify = verify
+    if manifest:
+        # Parts from earlier attempts were not checked this time
+        fresh = not manifest.parts
+        await _resume_download(downloader, location, out, manifest, progress_callback)
+        if verify:
+            out.verified = fresh and downloader.verified
+        return out
+    if isinstance(out, FileSink):
+        await _positional_download(downloader, location, out, progress_callback)
+        if verify:
+            out.verified = downloader.verified
+        return out
+    downloaded = downloader.download(location, size)
+    writer = WriteBehind(out.write)
+    done = 0
+    try:
+        async for x in downloaded:
+            await writer.put(x)
+            done += len(x)
+            if progress_callback:
+                await _report_progress(progress_callback, done, size)
+        await writer.drain()
+    finally:
+        # Hands the senders back to the pool even if writing to `out` failed
+        await downloaded.aclose()
+        await writer.close()
+
+    if verify:
+        out.verified = downloader.verified
+    return out
+
+
+async def _small_download(
+    client: TelegramClient,
+    info,
+    out: Union[BinaryIO, FileSink],
     progress_callback: callable = None,
-) -> BinaryIO:
+    verify: bool = False,
+) -> Union[BinaryIO, FileSink]:
+    hashes = None
+    if verify:
+        hashes = PartHashes(
+            lambda sender, offset: _call_on_dc(
+                client, info.dc_id, GetFileHashesRequest(info.location, offset)
+            )
+        )
+    done = 0
+    downloaded = _small_parts(client, info.dc_id, info.location, info.size, hashes)
+    try:
+        async for data in downloaded:
+            if isinstance(out, FileSink):
+                await run_io(out.write_at, done, data)
+            else:
+                await run_io(out.write, data)
+            done += len(data)
+            if progress_callback:
+                await _report_progress(progress_callback, done, info.size or done)
+    finally:
+        await downloaded.aclose()
+    if verify:
+        out.verified = not hashes.unverified
+    return out
+
+
+async def _positional_download(
+    downloader: ParallelTransferrer,
+    location: TypeLocation,
+    out: FileSink,
+    progress_callback: callable = None,
+) -> FileSink:
+    part_size = utils.get_appropriated_part_size(out.size) * 1024
+    done = 0
+    # Parts are written wherever they belong, so there is no need to wait for them in order
+    downloaded = downloader.download_parts(
+        location, out.size, part_size_kb=part_size / 1024, ordered=False
+    )
+    writer = WriteBehind(out.write_at)
+    try:
+        async for index, x in downloaded:
+            await writer.put(index * part_size, x)
+            done += len(x)
+            if progress_callback:
+                await _report_progress(progress_callback, done, out.size)
+        await writer.drain()
+    finally:
+        await downloaded.aclose()
+        await writer.close()
+
+    return out
+
+
+async def _resume_download(
+    downloader: ParallelTransferrer,
+    location: TypeLocation,
+    out: FileSink,
+    manifest: DownloadManifest,
+    progress_callback: callable = None,
+) -> FileSink:
+    done = manifest.done_bytes
+    downloaded = downloader.download_parts(
+        location,
+        manifest.size,
+        part_size_kb=manifest.part_size / 1024,
+        parts=manifest.missing(),
+        ordered=False,
+    )
+
+    # Positional writes go straight to the OS, so a part is listed once its write returned
+    writer = WriteBehind(out.write_at)
+    try:
+        async for index, x in downloaded:
+            await writer.put(
+                index * manifest.part_size,
+                x,
+                done=lambda index=index: manifest.parts.add(index),
+            )
+            done += len(x)
+            await manifest.save(force=False)
+            if progress_callback:
+                await _report_progress(progress_callback, done, manifest.size)
+        await writer.drain()
+    except BaseException:
+        # Whatever reached the file so far is kept for the next attempt
+        await writer.close()
+        await manifest.save()
+        raise
+    finally:
+        await downloaded.aclose()
+
+    await run_io(out.truncate, manifest.size)
+    await run_io(manifest.remove)
+    return out
+
+
+async def stream_range(
+    client: TelegramClient,
+    location: TypeLocation,
+    offset: int = 0,
+    length: Optional[int] = None,
+    priority: int = PRIORITY_NORMAL,
+) -> AsyncGenerator[bytes, None]:
     size = location.size
+    end = size if length is None else min(size, offset + length)
+    if offset < 0 or offset > size:
+        raise ValueError(f"Offset {offset} is outside of a {size} byte file")
+    if end <= offset:
+        return
     dc_id, location = utils.get_input_location(location)
-    # We lock the transfers because telegram has connection count limits
-    downloader = ParallelTransferrer(client, dc_id)
-    downloaded = downloader.download(location, size)
-    async for x in downloaded:
-        out.write(x)
+    part_size = utils.get_appropriated_part_size(size) * 1024
+    # Telegram only serves whole parts, the first and last one are trimmed to the range
+    first, last = offset // part_size, (end - 1) // part_size
+    downloader = ParallelTransferrer(client, dc_id, priority)
+    # Parts are fetched in order, so the read-ahead stays just past what was yielded so far
+    downloaded = downloader.download_parts(
+        location, size, part_size_kb=part_size / 1024, parts=range(first, last + 1)
+    )
+    try:
+        async for index, x in downloaded:
+            start = index * part_size
+            yield x[max(offset - start, 0) : end - start]
+    finally:
+        await downloaded.aclose()
+
+
+class DownloadCache:
+    """
+    Shared on-disk cache of downloaded documents, keyed by document id and
+    access hash. Concurrent requests for the same document join a single
+    download, and callers get their own path as a hardlink to the cached file.
+    """
+
+    directory: str
+    max_size: int
+    size: int
+
+    def __init__(self, directory: str, max_size: int = 10 * 1024 ** 3) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        # Least recently used first, the order survives restarts through the mtimes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._flights: Dict[str, asyncio.Task] = {}
+        self._callbacks: DefaultDict[str, List[Callable]] = defaultdict(list)
+        # Entries being linked out right now, eviction leaves them alone
+        self._pinned: DefaultDict[str, int] = defaultdict(int)
+        # Evicted files the I/O threads are still removing
+        self._removals: Dict[str, asyncio.Future] = {}
+        # Entries downloaded with every part verified, files found on disk are not
+        self._verified: Set[str] = set()
+        found = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".part"):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+        self.size = sum(self._entries.values())
+
+    @staticmethod
+    def key(location: TypeLocation) -> str:
+        return f"{location.id}-{location.access_hash & 0xFFFFFFFFFFFFFFFF:x}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    async def fetch(
+        self,
+        client: TelegramClient,
+        location: TypeLocation,
+        progress_callback: callable = None,
+        priority: int = PRIORITY_NORMAL,
+        verify: bool = False,
+    ) -> str:
+        key = self.key(location)
+        if key in self._entries:
+            self._pin(key)
+            try:
+                await run_io(os.utime, self.path(key))
+            except FileNotFoundError:
+                self.size -= self._entries.pop(key, 0)
+                self._verified.discard(key)
+            else:
+                # Another caller may have found the file missing in the meantime
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    if progress_callback:
+                        await _report_progress(progress_callback, location.size, location.size)
+                    return self.path(key)
+            finally:
+                self._unpin(key)
         if progress_callback:
-            r = progress_callback(out.tell(), size)
-            if inspect.isawaitable(r):
-                try:
-                    await r
-                except BaseException:
-                    pass
+            self._callbacks[key].append(progress_callback)
+        flight = self._flights.get(key)
+        if not flight:
+            flight = self._flights[key] = client.loop.create_task(
+                self._download(client, location, key, priority, verify)
+            )
+        try:
+            # Someone giving up on the download doesn't cancel it for everybody else
+            return await asyncio.shield(flight)
+        finally:
+            if progress_callback in self._callbacks.get(key, ()):
+                self._callbacks[key].remove(progress_callback)
 
-    return out
+    async def save_to(
+        self,
+        client: TelegramClient,
+        location: TypeLocation,
+        destination: str,
+        progress_callback: callable = None,
+        priority: int = PRIORITY_NORMAL,
+        verify: bool = False,
+    ) -> str:
+        key = self.key(location)
+        self._pin(key)
+        try:
+            path = await self.fetch(client, location, progress_callback, priority, verify)
+            return await run_io(self.link, path, destination)
+        finally:
+            self._unpin(key)
+
+    def verified(self, location: TypeLocation) -> bool:
+        # Joining a download someone else started without `verify` leaves it unverified
+        return self.key(location) in self._verified
+
+    def _pin(self, key: str) -> None:
+        self._pinned[key] += 1
+
+    def _unpin(self, key: str) -> None:
+        self._pinned[key] -= 1
+        if not self._pinned[key]:
+            del self._pinned[key]
+
+    async def _download(
+        self,
+        client: TelegramClient,
+        location: TypeLocation,
+        key: str,
+        priority: int,
+        verify: bool = False,
+    ) -> str:
+        async def progress_callback(current: int, total: int) -> None:
+            for callback in list(self._callbacks.get(key, ())):
+                await _report_progress(callback, current, total)
+
+        sink = None
+        try:
+            # An evicted copy still being removed must not take the new one with it
+            removal = self._removals.get(key)
+            if removal:
+                await asyncio.wait([removal])
+            sink = await run_io(FileSink, self.path(key), location.size)
+            await download_file(
+                client, location, sink, progress_callback, priority, verify=verify
+            )
+            path = await run_io(sink.commit)
+        except BaseException:
+            if sink:
+                sink.close(keep=False)
+            raise
+        finally:
+            del self._flights[key]
+            self._callbacks.pop(key, None)
+        self._entries[key] = location.size
+        self.size += location.size
+        if sink.verified:
+            self._verified.add(key)
+        evicted = self._evict()
+        if evicted:
+            await self._remove(evicted)
+        return path
+
+    def _evict(self) -> List[str]:
+        # Bookkeeping stays on the event loop, only the removals go to the I/O threads.
+        # The newest entry always stays, its callers are about to link it.
+        evicted = []
+        for key in list(self._entries)[:-1]:
+            if self.size <= self.max_size:
+                break
+            if key in self._pinned:
+                continue
+            self.size -= self._entries.pop(key)
+            self._verified.discard(key)
+            evicted.append(key)
+        return evicted
+
+    async def _remove(self, keys: List[str]) -> None:
+        removal = run_io(self._remove_files, [self.path(key) for key in keys])
+        for key in keys:
+            self._removals[key] = removal
+        try:
+            await removal
+        finally:
+            for key in keys:
+                if self._removals.get(key) is removal:
+                    del self._removals[key]
+
+    @staticmethod
+    def _remove_files(paths: List[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def link(path: str, destination: str) -> str:
+        # Hardlinks cost nothing and outlive eviction from the cache, files are only
+        # copied across filesystems
+        tmp_path = f"{destination}.link"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, destination)
+        return destination
+
+
+def _is_regular_file(file: BinaryIO) -> bool:
+    try:
+        return os.path.isfile(file.name)
+    except (AttributeError, TypeError):
+        return False
 
 
 async def upload_file(
@@ -403,6 +2679,557 @@ async def upload_file(
     file: BinaryIO,
     name=None,
     progress_callback: callable = None,
+    priority: int = PRIORITY_NORMAL,
 ) -> TypeInputFile:
+    if process_pool and _is_regular_file(file) and os.path.getsize(file.name) >= PROCESS_TRANSFER_SIZE:
+        return await process_pool.upload(
+            client, file, name, progress_callback, priority
+        )
     # Pass the name parameter directly to _internal_transfer_to_telegram
-    return (await _internal_transfer_to_telegram(client, file, progress_callback, name))[0]
+    return (
+        await _internal_transfer_to_telegram(
+            client, file, progress_callback, name, priority
+        )
+    )[0]
+
+
+class ClientPool:
+    """
+    Several accounts that can all reach the same files. Every account runs
+    one transfer with its own file reference and connections, all of them
+    taking parts from a shared queue, so one file can move faster than a
+    single account's limits allow. An account that gets a long FLOOD_WAIT
+    hands its unfinished parts back to the others.
+    """
+
+    clients: List[TelegramClient]
+    flood_rebalance: float
+
+    def __init__(
+        self,
+        clients: Iterable[TelegramClient],
+        flood_rebalance: float = 2.0,
+    ) -> None:
+        self.clients = list(clients)
+        # FLOOD_WAITs longer than this move the account's parts to the others
+        self.flood_rebalance = flood_rebalance
+        self._paused_until: Dict[TelegramClient, float] = {}
+        self._active: DefaultDict[TelegramClient, int] = defaultdict(int)
+
+    async def _resolve(
+        self,
+        location: Union[TypeLocation, Callable[[TelegramClient], Awaitable[TypeLocation]]],
+    ) -> Dict[TelegramClient, TypeLocation]:
+        if not callable(location):
+            return {client: location for client in self.clients}
+        resolved = await asyncio.gather(
+            *[location(client) for client in self.clients], return_exceptions=True
+        )
+        locations = {}
+        for client, result in zip(self.clients, resolved):
+            if isinstance(result, BaseException) or result is None:
+                log.warning(f"Client {client!r} can't reach the file: {result!r}")
+            else:
+                locations[client] = result
+        if not locations:
+            raise ValueError("None of the clients can reach the file")
+        return locations
+
+    async def download(
+        self,
+        location: Union[TypeLocation, Callable[[TelegramClient], Awaitable[TypeLocation]]],
+        out: Union[BinaryIO, FileSink],
+        progress_callback: callable = None,
+        priority: int = PRIORITY_NORMAL,
+        verify: bool = False,
+    ) -> Union[BinaryIO, FileSink]:
+        # `location` may be a coroutine function that gets the file for each client, file
+        # references are only valid for the account that fetched them
+        locations = await self._resolve(location)
+        size = next(iter(locations.values())).size
+        part_size = utils.get_appropriated_part_size(size) * 1024
+        part_count = math.ceil(size / part_size)
+        # One queue for every account, each takes the next part as soon as it has room
+        parts = deque(range(part_count))
+        arrived: Set[int] = set()
+        writer = WriteBehind(functools.partial(_write_at, out))
+        errors: List[Exception] = []
+        transferrers: List[ParallelTransferrer] = []
+        done = 0
+
+        async def run_client(client: TelegramClient) -> None:
+            nonlocal done
+            dc_id, input_location = utils.get_input_location(locations[client])
+            # A single transfer per account for the whole file, so it gets the account's
+            # full connection budget and its tuner learns as the file goes
+            transferrer = ParallelTransferrer(client, dc_id, priority)
+            task = asyncio.current_task()
+            moved = False
+
+            def on_flood(seconds: float) -> None:
+                nonlocal moved
+                self._paused_until[client] = time.monotonic() + seconds
+                if seconds > self.flood_rebalance and not moved:
+                    moved = True
+                    task.cancel()
+
+            transferrer.on_flood = on_flood
+            transferrer.verify = verify
+            transferrers.append(transferrer)
+            downloaded = transferrer.download_parts(
+                input_location, size, part_size_kb=part_size / 1024, queue=parts
+            )
+            self._active[client] += 1
+            try:
+                async for index, data in downloaded:
+                    if index in arrived:
+                        continue
+                    arrived.add(index)
+                    await writer.put(index * part_size, data)
+                    done += len(data)
+                    if progress_callback:
+                        await _report_progress(progress_callback, done, size)
+            except asyncio.CancelledError:
+                if not moved:
+                    raise
+                log.info(f"Moving parts away from {client!r} while it waits out a FLOOD_WAIT")
+            except Exception as e:
+                log.warning(f"Client {client!r} dropped out of the download: {e!r}")
+                errors.append(e)
+                del locations[client]
+            finally:
+                await downloaded.aclose()
+                self._active[client] -= 1
+
+        try:
+            while len(arrived) < part_count:
+                if not locations:
+                    raise errors[-1]
+                # Parts a flooded or failed account was working on come back once every
+                # account is done with the queue
+                missing = sorted(set(range(part_count)) - arrived)
+                parts.clear()
+                parts.extend(missing)
+                now = time.monotonic()
+                ready = [c for c in locations if self._paused_until.get(c, 0) <= now]
+                if not ready:
+                    await asyncio.sleep(
+                        min(self._paused_until[c] for c in locations) - now
+                    )
+                    continue
+                # Tasks of their own, so a FLOOD_WAIT can call off just one account
+                await asyncio.gather(
+                    *[asyncio.ensure_future(run_client(client)) for client in ready]
+                )
+            await writer.drain()
+        finally:
+            await writer.close()
+        if verify:
+            out.verified = all(transferrer.verified for transferrer in transferrers)
+        return out
+
+    async def upload(
+        self,
+        file: BinaryIO,
+        name: Optional[str] = None,
+        progress_callback: callable = None,
+        priority: int = PRIORITY_NORMAL,
+    ) -> Tuple[TelegramClient, TypeInputFile]:
+        # Uploaded parts belong to the account that sent them, so a whole file goes to the
+        # least busy account that isn't waiting out a FLOOD_WAIT
+        now = time.monotonic()
+        client = min(
+            self.clients,
+            key=lambda c: (self._paused_until.get(c, 0) > now, self._active[c]),
+        )
+        self._active[client] += 1
+        try:
+            return client, await upload_file(client, file, name, progress_callback, priority)
+        finally:
+            self._active[client] -= 1
+
+
+class UploadCache:
+    """
+    Remembers the files a client uploaded, keyed by path, size and mtime, so
+    sending the same file again reuses the uploaded handle while Telegram
+    still keeps it. Concurrent uploads of the same file share one upload.
+    """
+
+    ttl: float
+
+    def __init__(self, client: TelegramClient, ttl: float = 3600) -> None:
+        # Only a weak reference, upload_caches must not keep the client alive
+        self._client = weakref.ref(client)
+        self.ttl = ttl
+        self._entries: Dict[Tuple[str, int, int], Tuple[float, TypeInputFile]] = {}
+        self._flights: Dict[Tuple[str, int, int], asyncio.Task] = {}
+        self._callbacks: DefaultDict[Tuple[str, int, int], List[Callable]] = defaultdict(list)
+
+    @property
+    def client(self) -> Optional[TelegramClient]:
+        return self._client()
+
+    async def upload(
+        self,
+        path: str,
+        name: Optional[str] = None,
+        progress_callback: callable = None,
+        priority: int = PRIORITY_NORMAL,
+    ) -> TypeInputFile:
+        stat = await run_io(os.stat, path)
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            if progress_callback:
+                await _report_progress(progress_callback, stat.st_size, stat.st_size)
+            return self._renamed(entry[1], name)
+        if progress_callback:
+            self._callbacks[key].append(progress_callback)
+        flight = self._flights.get(key)
+        if not flight:
+            flight = self._flights[key] = self.client.loop.create_task(
+                self._upload(key, name, priority)
+            )
+        try:
+            # Someone giving up on the upload doesn't cancel it for everybody else
+            return self._renamed(await asyncio.shield(flight), name)
+        finally:
+            if progress_callback in self._callbacks.get(key, ()):
+                self._callbacks[key].remove(progress_callback)
+
+    def forget(self, path: str) -> None:
+        path = os.path.realpath(path)
+        for key in [key for key in self._entries if key[0] == path]:
+            del self._entries[key]
+
+    async def _upload(
+        self, key: Tuple[str, int, int], name: Optional[str], priority: int
+    ) -> TypeInputFile:
+        async def progress_callback(current: int, total: int) -> None:
+            for callback in list(self._callbacks.get(key, ())):
+                await _report_progress(callback, current, total)
+
+        try:
+            with open(key[0], "rb") as f:
+                result = await upload_file(
+                    self.client, f, name, progress_callback, priority
+                )
+        finally:
+            del self._flights[key]
+            self._callbacks.pop(key, None)
+        now = time.monotonic()
+        for stale in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[stale]
+        self._entries[key] = (now + self.ttl, result)
+        return result
+
+    @staticmethod
+    def _renamed(file: TypeInputFile, name: Optional[str]) -> TypeInputFile:
+        # The parts are the same, only the name the file is sent under changes
+        if not name or file.name == name:
+            return file
+        file = copy.copy(file)
+        file.name = name
+        return file
+
+
+upload_caches: "weakref.WeakKeyDictionary[TelegramClient, UploadCache]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_upload_cache(client: TelegramClient) -> UploadCache:
+    if client not in upload_caches:
+        upload_caches[client] = UploadCache(client)
+    return upload_caches[client]
+
+
+class _WorkerLoggers(dict):
+    def __missing__(self, key: str) -> logging.Logger:
+        return logging.getLogger(key)
+
+
+class WorkerClient:
+    """
+    Just enough of a TelegramClient for ParallelTransferrer to run in a
+    worker process, on the authorization key of the client that handed it
+    the work. Its senders stay pooled between the shards the worker runs.
+    """
+
+    def __init__(
+        self,
+        dc_id: int,
+        ip_address: str,
+        port: int,
+        auth_key: bytes,
+        connection: type,
+        proxy,
+    ) -> None:
+        self.loop = asyncio.get_event_loop()
+        self.session = type("WorkerSession", (), {})()
+        self.session.dc_id = dc_id
+        self.session.auth_key = AuthKey(auth_key)
+        self._dc = type("WorkerDc", (), {"id": dc_id, "ip_address": ip_address, "port": port})
+        self._connection = connection
+        self._proxy = proxy
+        self._log = _WorkerLoggers()
+
+    async def _get_dc(self, dc_id: int, cdn: bool = False):
+        return self._dc
+
+    async def _call(self, sender: MTProtoSender, request, ordered: bool = False, flood_sleep_threshold=None):
+        return await sender.send(request)
+
+
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_clients: Dict[Tuple, WorkerClient] = {}
+
+
+def _run_in_worker(transfer: Callable[[dict], Awaitable[int]], job: dict) -> int:
+    # One loop per worker process for its whole life, so pooled senders outlive a shard
+    global _worker_loop
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_worker_loop)
+    return _worker_loop.run_until_complete(transfer(job))
+
+
+def _worker_client(job: dict) -> WorkerClient:
+    key = (job["dc_id"], job["auth_key"])
+    if key not in _worker_clients:
+        _worker_clients[key] = WorkerClient(
+            job["dc_id"], job["ip_address"], job["port"], job["auth_key"], job["connection"], job["proxy"]
+        )
+    return _worker_clients[key]
+
+
+async def _download_shard(job: dict) -> int:
+    location = BinaryReader(job["location"]).tgread_object()
+    part_size = job["part_size"]
+    transferrer = ParallelTransferrer(_worker_client(job), job["dc_id"])
+    # Worker clients can't set up CDN connections, their shards stay on the origin DC
+    transferrer._cdn_supported = False
+    # Every worker writes its parts at their offsets into the file the parent preallocated
+    sink = FileSink(job["path"], job["size"], resume=True)
+    writer = WriteBehind(sink.write_at)
+    downloaded = transferrer.download_parts(
+        location,
+        job["size"],
+        part_size_kb=part_size / 1024,
+        connection_count=job["connections"],
+        parts=job["parts"],
+        ordered=False,
+    )
+    done = 0
+    try:
+        async for index, data in downloaded:
+            await writer.put(index * part_size, data)
+            done += len(data)
+        await writer.drain()
+    finally:
+        await downloaded.aclose()
+        await writer.close()
+        sink.close()
+    return done
+
+
+async def _upload_shard(job: dict) -> int:
+    transferrer = ParallelTransferrer(_worker_client(job))
+    part_size, _, _ = await transferrer.init_upload(
+        job["file_id"], job["size"], connection_count=job["connections"]
+    )
+    parts = iter(job["parts"])
+    fd = os.open(job["path"], os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def read() -> Optional[Tuple[int, bytes]]:
+        index = next(parts, None)
+        if index is None:
+            return None
+        return index, os.pread(fd, part_size, index * part_size)
+
+    reader = ReadAhead(read)
+    done = 0
+    try:
+        async for index, data in reader:
+            # Parts are numbered by their place in the file, not by the order they are sent in
+            transferrer.upload_part = index
+            await transferrer.upload(data)
+            done += len(data)
+    except BaseException:
+        await transferrer._cleanup(healthy=False)
+        raise
+    finally:
+        await reader.close()
+        os.close(fd)
+    await transferrer.finish_upload()
+    return done
+
+
+def _run_download_shard(job: dict) -> int:
+    return _run_in_worker(_download_shard, job)
+
+
+def _run_upload_shard(job: dict) -> int:
+    return _run_in_worker(_upload_shard, job)
+
+
+class ProcessTransferPool:
+    """
+    Worker processes that take over large transfers, so encrypting and
+    decrypting their MTProto traffic is spread over several cores instead of
+    sharing the event loop's. A transfer is split into shards of consecutive
+    parts, every shard runs in a worker on the client's authorization key and
+    goes straight from/to the file at its offsets.
+    """
+
+    processes: int
+    connections: int
+    shard_parts: int
+
+    def __init__(
+        self,
+        processes: Optional[int] = None,
+        connections: int = 4,
+        shard_parts: int = 64,
+    ) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        # Connections each shard opens, and parts per shard
+        self.connections = connections
+        self.shard_parts = shard_parts
+        self._executor = ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    async def _job(self, client: TelegramClient, dc_id: Optional[int]) -> dict:
+        dc_id = dc_id or client.session.dc_id
+        if dc_id == client.session.dc_id:
+            auth_key = client.session.auth_key
+        else:
+            # Makes sure the authorization is imported once, in this process
+            transferrer = ParallelTransferrer(client, dc_id)
+            sender = await transferrer.pool.acquire(transferrer._create_sender)
+            transferrer.pool.release(sender)
+            auth_key = get_auth_cache(client).keys[dc_id]
+        dc = await client._get_dc(dc_id)
+        return {
+            "dc_id": dc_id,
+            "ip_address": dc.ip_address,
+            "port": dc.port,
+            "auth_key": auth_key.key,
+            "connection": client._connection,
+            "proxy": client._proxy,
+        }
+
+    async def _run(
+        self,
+        client: TelegramClient,
+        job: dict,
+        run: Callable[[dict], int],
+        part_count: int,
+        size: int,
+        progress_callback: callable,
+        priority: int,
+    ) -> None:
+        shards = [
+            list(range(start, min(start + self.shard_parts, part_count)))
+            for start in range(0, part_count, self.shard_parts)
+        ]
+        # The workers' connections count against the same budget as everybody else's
+        ticket = await transfer_scheduler.admit(
+            client, job["dc_id"], self.processes * self.connections, size, priority
+        )
+        running = max(1, min(self.processes, len(shards), ticket.granted // self.connections))
+        job["connections"] = max(1, min(self.connections, ticket.granted // running))
+        started: List[concurrent.futures.Future] = []
+        pending: Set[asyncio.Future] = set()
+        done = 0
+        try:
+            for shard in shards:
+                if len(pending) >= running:
+                    finished, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    done += sum(future.result() for future in finished)
+                    if progress_callback:
+                        await _report_progress(progress_callback, done, size)
+                started.append(self._executor.submit(run, {**job, "parts": shard}))
+                pending.add(asyncio.wrap_future(started[-1]))
+            for future in asyncio.as_completed(pending):
+                done += await future
+                if progress_callback:
+                    await _report_progress(progress_callback, done, size)
+        finally:
+            # Shards that already started can't be stopped, the file must outlive them
+            for future in started:
+                future.cancel()
+            running_shards = [asyncio.wrap_future(f) for f in started if not f.done()]
+            if running_shards:
+                await asyncio.wait(running_shards)
+            ticket.release()
+
+    async def download(
+        self,
+        client: TelegramClient,
+        location: TypeLocation,
+        out: FileSink,
+        progress_callback: callable = None,
+        priority: int = PRIORITY_NORMAL,
+    ) -> FileSink:
+        dc_id, location = utils.get_input_location(location)
+        part_size = utils.get_appropriated_part_size(out.size) * 1024
+        job = await self._job(client, dc_id)
+        job.update(
+            location=bytes(location), path=out.name, size=out.size, part_size=part_size
+        )
+        await self._run(
+            client,
+            job,
+            _run_download_shard,
+            math.ceil(out.size / part_size),
+            out.size,
+            progress_callback,
+            priority,
+        )
+        return out
+
+    async def upload(
+        self,
+        client: TelegramClient,
+        file: BinaryIO,
+        name: Optional[str] = None,
+        progress_callback: callable = None,
+        priority: int = PRIORITY_NORMAL,
+    ) -> TypeInputFile:
+        size = os.path.getsize(file.name)
+        part_size = utils.get_appropriated_part_size(size) * 1024
+        part_count = math.ceil(size / part_size)
+        file_id = helpers.generate_random_long()
+        job = await self._job(client, None)
+        job.update(path=file.name, size=size, file_id=file_id)
+        await self._run(
+            client, job, _run_upload_shard, part_count, size, progress_callback, priority
+        )
+        return InputFileBig(file_id, part_count, name or os.path.basename(file.name))
+
+    def close(self) -> None:
+        try:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:
+            # cancel_futures is new in Python 3.9, queued shards still run there
+            self._executor.shutdown(wait=False)
+
+
+# Transfers at least this large go to the process pool, once one is enabled
+PROCESS_TRANSFER_SIZE = 64 * 1024 * 1024
+process_pool: Optional[ProcessTransferPool] = None
+
+
+def enable_process_pool(
+    processes: Optional[int] = None, connections: int = 4
+) -> ProcessTransferPool:
+    global process_pool
+    if process_pool:
+        process_pool.close()
+    process_pool = ProcessTransferPool(processes, connections)
+    return process_pool
@@ -11,9 +11,9 @@ setup(
     description="This repository aimed to be fast uploading and fast downloading via Telethon (user and bots both supported)",
     packages=find_packages(),
     install_requires=["telethon", "telethon-tgcrypto", "aiofiles"],
+    python_requires=">=3.7",
     classifiers=[
         "License :: OSI Approved :: MIT License",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",